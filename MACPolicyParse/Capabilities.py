@@ -0,0 +1,140 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Linux capability table, name <-> number, matching the capability= field the
+# kernel logs alongside capname=
+#
+# Capability rules are keyed by number for de-duplication and diffing, and security
+# checks (e.g. "no sys_admin") keep their capabilities as a CapabilitySet bitmap, so
+# each check is an integer test. Names we don't know about can't be mapped to a bit,
+# so they are tracked by name in 'unknown'.
+cap_table = [
+    "chown",
+    "dac_override",
+    "dac_read_search",
+    "fowner",
+    "fsetid",
+    "kill",
+    "setgid",
+    "setuid",
+    "setpcap",
+    "linux_immutable",
+    "net_bind_service",
+    "net_broadcast",
+    "net_admin",
+    "net_raw",
+    "ipc_lock",
+    "ipc_owner",
+    "sys_module",
+    "sys_rawio",
+    "sys_chroot",
+    "sys_ptrace",
+    "sys_pacct",
+    "sys_admin",
+    "sys_boot",
+    "sys_nice",
+    "sys_resource",
+    "sys_time",
+    "sys_tty_config",
+    "mknod",
+    "lease",
+    "audit_write",
+    "audit_control",
+    "setfcap",
+    "mac_override",
+    "mac_admin",
+    "syslog",
+    "wake_alarm",
+    "block_suspend",
+    "audit_read",
+    "perfmon",
+    "bpf",
+    "checkpoint_restore",
+]
+
+cap_numbers = {name: num for num, name in enumerate(cap_table)}
+
+# Returns -1 for unknown names
+def capNumber(name):
+    name = name.strip("\",").lower()
+    if name.startswith("cap_"):
+        name = name[4:]
+
+    return cap_numbers.get(name, -1)
+
+# Returns None for unknown numbers
+def capName(num):
+    try:
+        num = int(num)
+    except (TypeError, ValueError):
+        return None
+
+    if num < 0 or num >= len(cap_table):
+        return None
+
+    return cap_table[num]
+
+class CapabilitySet:
+    def __init__(self, bits=0):
+        self.bits = bits
+        self.unknown = set()
+
+    @staticmethod
+    def fromNames(names):
+        cs = CapabilitySet()
+        for name in names:
+            cs.addName(name)
+        return cs
+
+    def add(self, num):
+        self.bits |= 1 << num
+
+    def addName(self, name):
+        num = capNumber(name)
+        if num == -1:
+            self.unknown.add(name.strip("\",").lower())
+        else:
+            self.add(num)
+
+    def has(self, num):
+        return bool(self.bits & (1 << num))
+
+    def hasName(self, name):
+        num = capNumber(name)
+        if num == -1:
+            return name.strip("\",").lower() in self.unknown
+        return self.has(num)
+
+    def isEmpty(self):
+        return self.bits == 0 and not self.unknown
+
+    def names(self):
+        out = [cap_table[num] for num in range(len(cap_table)) if self.bits & (1 << num)]
+        return out + sorted(self.unknown)
+
+    def __eq__(self, other):
+        return isinstance(other, CapabilitySet) and \
+                self.bits == other.bits and self.unknown == other.unknown
+
+    def __hash__(self):
+        return hash((self.bits, frozenset(self.unknown)))
+
+    def __len__(self):
+        return bin(self.bits).count("1") + len(self.unknown)
+
+    def __repr__(self):
+        return "capability " + " ".join(self.names())
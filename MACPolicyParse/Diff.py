@@ -14,6 +14,9 @@
 # limitations under the License.
 #
 
+import hashlib
+import json
+
 #
 # This handles returning diffed profile data from the
 # profile handlers to the main output routine
@@ -28,3 +31,214 @@ class DiffResult:
         self.old_obj = old_obj
         self.new_obj = new_obj
         self.uuid = uuid
+
+#
+# In-memory profile diff
+#
+# Both sides are a header and a set of rule lines: the rules parsed from the existing
+# profile and the rules of the generated profile, before either is written out.
+# Rules are matched by their canonical identity (see ruleIdentity()), so a rule whose
+# details changed shows up as a change rather than a removal plus an addition.
+# Identical profiles are skipped on a content hash before any rule is looked at,
+# everything else is set operations and dict lookups.
+
+# Rule prefixes that are part of a rule's identity
+rule_qualifiers = ["audit", "deny", "allow", "owner"]
+
+#
+# Normalizes the whitespace of a rule and drops its trailing comma, so formatting
+# differences don't show up as changes. Subprofiles are one line per rule. Comments
+# (other than includes) come back empty, like splitProfileText() drops them.
+def normalizeRule(rule):
+    lines = []
+    for line in rule.splitlines():
+        line = " ".join(line.split()).rstrip(",")
+        if line != "":
+            lines.append(line)
+
+    if lines and lines[0][0] == "#" and not lines[0].startswith("#include"):
+        return ""
+    return "\n".join(lines)
+
+#
+# Splits profile text into (header, rules), for profiles that are only available as
+# text (reused from the profile cache). Comments (other than includes) and blank
+# lines are dropped and rules are normalized as normalizeRule() does. Subprofiles are
+# kept as one multi-line rule.
+def splitProfileText(text):
+    header = ""
+    rules = []
+    sub = None
+
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if line == "" or (line[0] == "#" and not line.startswith("#include")):
+            continue
+
+        if sub != None:
+            sub.append(line.rstrip(","))
+            if line == "}":
+                rules.append("\n".join(sub))
+                sub = None
+            continue
+
+        if line.endswith("{"):
+            if header == "":
+                header = line
+            else:
+                sub = [line]
+            continue
+
+        if line == "}":
+            continue
+
+        rules.append(line.rstrip(","))
+
+    return header, rules
+
+#
+# Canonical identity of a rule line. File rules are identified by their qualifiers
+# and path (through path_fn, if set), subprofiles by their header line, anything else
+# by the whole rule.
+def ruleIdentity(rule, path_fn=None):
+    tokens = rule.split("\n")[0].split()
+    if tokens == []:
+        return rule
+
+    if tokens[0] == "profile":
+        return tokens[0] + " " + " ".join(tokens[1:-1])
+
+    qualifiers = []
+    while len(tokens) > 1 and tokens[0] in rule_qualifiers:
+        qualifiers.append(tokens.pop(0))
+
+    if len(tokens) == 2 and (tokens[0].startswith("/") or tokens[0].startswith("@{")):
+        path = tokens[0]
+        if path_fn:
+            path = path_fn(path) or path
+        return " ".join(qualifiers + ["file", path])
+
+    return rule
+
+# Order independent hash of a profile
+def contentHash(header, rules):
+    h = hashlib.sha256(header.encode())
+    for rule in sorted(set(rules)):
+        h.update(b"\0" + rule.encode())
+    return h.hexdigest()
+
+#
+# Returns (added, removed, changed) between two rule lists, changed is a list of
+# (old rule, new rule) pairs
+def diffRules(old_rules, new_rules, path_fn=None):
+    old_set = set(old_rules)
+    new_set = set(new_rules)
+
+    old_ids = {}
+    for rule in old_set - new_set:
+        old_ids.setdefault(ruleIdentity(rule, path_fn), []).append(rule)
+
+    added = []
+    changed = []
+    for rule in sorted(new_set - old_set):
+        old_list = old_ids.get(ruleIdentity(rule, path_fn))
+        if old_list:
+            changed.append((old_list.pop(), rule))
+        else:
+            added.append(rule)
+
+    removed = sorted(rule for old_list in old_ids.values() for rule in old_list)
+
+    return added, removed, changed
+
+class ProfileDiff:
+    def __init__(self, name, status, old_hash=None, new_hash=None):
+        self.name = name
+        # new, changed or unchanged
+        self.status = status
+        self.old_hash = old_hash
+        self.new_hash = new_hash
+
+        self.header = None
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def toDict(self):
+        ret = {"name": self.name, "status": self.status, "old_hash": self.old_hash, "new_hash": self.new_hash}
+        if self.header:
+            ret["header"] = {"old": self.header[0], "new": self.header[1]}
+        ret["added"] = self.added
+        ret["removed"] = self.removed
+        ret["changed"] = [{"old": x[0], "new": x[1]} for x in self.changed]
+        return ret
+
+#
+# @old - (header, rules) of the existing profile, None for a new profile
+# @new - (header, rules) of the generated profile
+#
+# Rules are expected to be normalized, see normalizeRule()
+def diffProfileRules(name, old, new, path_fn=None):
+    new_header, new_rules = new
+    new_hash = contentHash(new_header, new_rules)
+
+    if old == None:
+        pd = ProfileDiff(name, "new", None, new_hash)
+        pd.added = sorted(set(new_rules))
+        return pd
+
+    old_header, old_rules = old
+    old_hash = contentHash(old_header, old_rules)
+
+    if old_hash == new_hash:
+        return ProfileDiff(name, "unchanged", old_hash, new_hash)
+
+    pd = ProfileDiff(name, "changed", old_hash, new_hash)
+    if old_header != new_header:
+        pd.header = (old_header, new_header)
+    pd.added, pd.removed, pd.changed = diffRules(old_rules, new_rules, path_fn)
+
+    return pd
+
+class DiffReport:
+    def __init__(self):
+        self.profiles = []
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+    def add(self, pd):
+        self.profiles.append(pd)
+        self.counts[pd.status] += 1
+
+    def printText(self):
+        print("******** Profile Diff Results *********")
+        print("\nResults: ")
+
+        for pd in self.profiles:
+            if pd.status == "new":
+                print("New profile : " + pd.name)
+
+        for pd in self.profiles:
+            if pd.status != "changed":
+                continue
+
+            print("Diff for profile: " + pd.name)
+            if pd.header:
+                print("Header: " + pd.header[0] + " -> " + pd.header[1])
+            print("Profile changes: ")
+            for old, new in pd.changed:
+                print(old + " -> " + new)
+            print("New profile entries: ")
+            for rule in pd.added:
+                print(rule)
+            print("Removed entries: ")
+            for rule in pd.removed:
+                print(rule)
+
+        print(f"\n{str(self.counts['new'])} new, {str(self.counts['changed'])} changed, {str(self.counts['unchanged'])} unchanged profiles")
+
+    def toDict(self):
+        return {"summary": self.counts, "profiles": [pd.toDict() for pd in self.profiles]}
+
+    def writeJSON(self, fp):
+        json.dump(self.toDict(), fp, indent=1)
+        fp.write("\n")
@@ -16,6 +16,11 @@
 
 import sys
 
+filter_path = "MACPolicyParse/filters/"
+
+# Filter name -> filter list, each filter module is only imported once per process
+_filter_sets = {}
+
 #
 # A very generic way of moving filters and SecurityCheck rules into their own files.
 #
@@ -30,10 +35,18 @@ class Filter:
 
         self.loadFilterSet()
 
+    #
+    # The list is loaded once and shared, callers must not modify it
     def loadFilterSet(self):
-        sys.path.append("MACPolicyParse/filters/")
+        filter_list = _filter_sets.get(self.filter_name)
+        if filter_list != None:
+            return filter_list
+
+        if filter_path not in sys.path:
+            sys.path.append(filter_path)
         mod = __import__(self.filter_name, globals(), locals(), [], 0)
 
         filter_cls = getattr(mod, self.filter_name)
         cls = filter_cls()
+        _filter_sets[self.filter_name] = cls.filter_list
         return cls.filter_list
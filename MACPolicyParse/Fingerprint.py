@@ -0,0 +1,229 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import os
+import tempfile
+
+from .Filter import *
+from .ProfileTypes import *
+from .Util import *
+
+#
+# Incremental regeneration support
+#
+# Each profile gets a fingerprint over everything that goes into generating it:
+# its parsed profile rules, the log entries merged into it, the tool version and the
+# filter/security check configuration. ProfileCache keeps the fingerprint and the
+# generated text from the last run, so profiles whose fingerprint didn't change can
+# reuse their previous output instead of being regenerated and re-checked.
+
+# Bump this when a change affects generated output without changing the inputs
+cache_format = 1
+
+# Configuration that affects every profile, hashed once per run
+def configFingerprint(options):
+    # Imported here, the package __init__ imports us indirectly
+    from . import __version__
+
+    h = hashlib.sha256()
+    h.update(("version:" + __version__ + ":" + str(cache_format) + "\n").encode())
+
+    for key in sorted(options):
+        h.update(("option:" + key + "=" + str(options[key]) + "\n").encode())
+
+    hashFilters(h, ["LogTypesFilter", "SecurityCheckList", "SecurityExceptionList"])
+
+    return h.hexdigest()
+
+def hashFilters(h, filter_names):
+    for filter_name in filter_names:
+        filters = Filter(filter_name).loadFilterSet()
+        entries = []
+        for entry in filters:
+            if isinstance(entry, str):
+                entries.append(entry + "=" + str(filters[entry]))
+            else:
+                entries.append(repr(sorted(vars(entry).items())))
+
+        for entry in sorted(entries):
+            h.update((filter_name + ":" + entry + "\n").encode())
+
+# The security check and exception lists, security verdicts are only valid for these
+def checkSetFingerprint():
+    from . import __version__
+
+    h = hashlib.sha256()
+    h.update(("version:" + __version__ + ":" + str(cache_format) + "\n").encode())
+    hashFilters(h, ["SecurityCheckList", "SecurityExceptionList"])
+
+    return h.hexdigest()
+
+def _ruleString(obj):
+    if isinstance(obj, ProfileHeaderRule):
+        return obj.getProfileHeader()
+
+    # getDefaultRule() rewrites library paths in place, which would change how the
+    # rule is matched during de-duplication, so use the parsed values
+    if isinstance(obj, FileRule):
+        return obj.filename + " " + obj.permissions
+
+    return str(obj.getDefaultRule())
+
+#
+# @config_fp - Result of configFingerprint()
+# @header - (name, filename, exe path) for the profile
+# @profile_objs - Parsed profile rules, may be None
+# @log_objs - Log entries for the profile, may be None
+def profileFingerprint(config_fp, header, profile_objs, log_objs):
+    h = hashlib.sha256()
+    h.update((config_fp + "\n").encode())
+    h.update(("header:" + "\0".join(str(x) for x in header) + "\n").encode())
+
+    # Log line order isn't stable between runs, and neither are repeats, so both
+    # lists are hashed as sorted sets
+    for tag, objs in [("profile", profile_objs), ("log", log_objs)]:
+        if not objs:
+            continue
+
+        rules = set()
+        for obj in objs:
+            rules.add(type(obj).__name__ + ":" + _ruleString(obj))
+
+        for rule in sorted(rules):
+            h.update((tag + ":" + rule + "\n").encode())
+
+    return h.hexdigest()
+
+#
+# On-disk cache of generated profiles from the last run, keyed by profile name.
+# Only the profiles generated (or reused) in the current run are written back.
+class ProfileCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.new_entries = {}
+        self.hits = 0
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            GlobalLogger.warning("Could not read profile cache, regenerating everything: %s", self.path)
+            return
+
+        if data.get("format") != cache_format:
+            return
+
+        self.entries = data.get("profiles", {})
+
+    # Returns the cached entry if the fingerprint matches, None otherwise
+    def get(self, name, fingerprint):
+        entry = self.entries.get(name)
+        if entry == None or entry["fingerprint"] != fingerprint:
+            return None
+
+        self.hits += 1
+        return entry
+
+    def put(self, name, fingerprint, entry):
+        cur = dict(entry)
+        cur["fingerprint"] = fingerprint
+        self.new_entries[name] = cur
+
+    def save(self):
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".macpp_cache")
+
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"format": cache_format, "profiles": self.new_entries}, fp)
+
+        os.replace(tmp_path, self.path)
+
+#
+# On-disk cache of security check verdicts, keyed by profile and rendered rule.
+#
+# For each profile (name and exe path, ProfilePath exceptions depend on the latter)
+# this keeps the names of the checks each rule violates, so only rules that are new
+# or changed since the last run need checking. The verdicts are only valid for the
+# check list they were made with, when checkSetFingerprint() changes everything is
+# checked again.
+class SecurityCache:
+    def __init__(self, path):
+        self.path = path
+        self.check_fp = checkSetFingerprint()
+        self.entries = {}
+
+        # Rules checked and rules reused from the cache during this run
+        self.checked = 0
+        self.reused = 0
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            GlobalLogger.warning("Could not read security cache, re-checking everything: %s", self.path)
+            return
+
+        if data.get("format") != cache_format:
+            return
+
+        if data.get("check_fingerprint") != self.check_fp:
+            GlobalLogger.info("Security checks changed since the last run, re-checking every rule")
+            return
+
+        self.entries = data.get("profiles", {})
+
+    # Returns {rule: [violated check names]} from the last run for the profile
+    def getProfile(self, name, exe_path):
+        entry = self.entries.get(name)
+        if entry == None or entry["exe_path"] != exe_path:
+            return {}
+
+        return dict(entry["rules"])
+
+    # Replaces the profile's verdicts, old is what getProfile() returned
+    def putProfile(self, name, exe_path, verdicts, old):
+        for rule in verdicts:
+            if rule in old:
+                self.reused += 1
+            else:
+                self.checked += 1
+
+        self.entries[name] = {"exe_path": exe_path, "rules": verdicts}
+
+    # Profiles that weren't checked this run keep their verdicts
+    def save(self):
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".macpp_seccache")
+
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"format": cache_format, "check_fingerprint": self.check_fp, "profiles": self.entries}, fp)
+
+        os.replace(tmp_path, self.path)
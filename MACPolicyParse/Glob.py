@@ -0,0 +1,234 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+
+from .Permissions import *
+from .Util import *
+
+#
+# AppArmor glob handling
+#
+# AppArmor globs are compiled to regular expressions once and cached:
+#   *       - any number of characters, except /
+#   **      - any number of characters, including /
+#   ?       - a single character, except /
+#   {a,b}   - alternation, can be nested and contain globs
+#   [...]   - character class, [^...] negates it
+#
+# Variables (@{HOME} etc) can't be expanded here, so patterns that use them
+# never match anything.
+
+glob_chars = "*?[{"
+
+_glob_cache = {}
+
+def isGlob(path):
+    for c in glob_chars:
+        if c in path:
+            return True
+    return False
+
+# Everything before the first glob character
+def literalPrefix(pattern):
+    for idx, c in enumerate(pattern):
+        if c in glob_chars or c == "\\":
+            return pattern[:idx]
+    return pattern
+
+def _globToRegex(pattern, idx, in_alt):
+    out = ""
+
+    while idx < len(pattern):
+        c = pattern[idx]
+
+        if c == "\\" and idx + 1 < len(pattern):
+            out += re.escape(pattern[idx + 1])
+            idx += 2
+            continue
+
+        if c == "*":
+            if pattern[idx:idx + 2] == "**":
+                out += ".*"
+                idx += 2
+            else:
+                out += "[^/]*"
+                idx += 1
+            continue
+
+        if c == "?":
+            out += "[^/]"
+            idx += 1
+            continue
+
+        if c == "[":
+            end = pattern.find("]", idx + 2)
+            if end == -1:
+                raise ValueError("Unterminated character class in " + pattern)
+
+            body = pattern[idx + 1:end]
+            negate = ""
+            if body[0] == "^":
+                negate = "^"
+                body = body[1:]
+            out += "[" + negate + body.replace("\\", "\\\\") + "]"
+            idx = end + 1
+            continue
+
+        if c == "{":
+            alts = []
+            idx += 1
+            while True:
+                alt, idx = _globToRegex(pattern, idx, True)
+                alts.append(alt)
+
+                if idx >= len(pattern):
+                    raise ValueError("Unterminated alternation in " + pattern)
+                if pattern[idx] == "}":
+                    idx += 1
+                    break
+                idx += 1 # ,
+            out += "(?:" + "|".join(alts) + ")"
+            continue
+
+        if in_alt and c in ",}":
+            return out, idx
+
+        out += re.escape(c)
+        idx += 1
+
+    return out, idx
+
+# Returns the compiled regex for the pattern, or None if it can't be used
+def compileGlob(pattern):
+    if pattern in _glob_cache:
+        return _glob_cache[pattern]
+
+    compiled = None
+    if "@{" not in pattern:
+        try:
+            regex, idx = _globToRegex(pattern, 0, False)
+            compiled = re.compile(regex, re.DOTALL)
+        except (ValueError, IndexError, re.error):
+            GlobalLogger.warning("Could not compile glob: %s", pattern)
+
+    _glob_cache[pattern] = compiled
+    return compiled
+
+def globMatch(pattern, path):
+    compiled = compileGlob(pattern)
+    if compiled == None:
+        return False
+
+    return compiled.fullmatch(path) != None
+
+#
+# True if every path matched by 'path' is also matched by 'pattern'. 'path' may
+# itself be a glob, in which case we only accept the cases we can prove: an identical
+# pattern, a trailing /** over the same directory, or a trailing /* over a
+# single path component.
+def globCovers(pattern, path):
+    if not isGlob(path):
+        return globMatch(pattern, path)
+
+    if pattern == path:
+        return True
+
+    if pattern.endswith("/**") and not isGlob(pattern[:-2]):
+        return path.startswith(pattern[:-2])
+
+    if pattern.endswith("/*") and not isGlob(pattern[:-1]):
+        rest = path[len(pattern) - 1:]
+        return path.startswith(pattern[:-1]) and "/" not in rest and "**" not in rest and "{" not in rest
+
+    return False
+
+class _PathNode:
+    def __init__(self):
+        self.children = {}
+        self.globs = []
+
+#
+# Per-profile index answering "is this path + permission already granted?"
+#
+# Literal rules are kept in a dict. Glob rules are hung off a trie of their literal
+# prefix's directory components, so a lookup only tests the globs that sit on the
+# directories leading to the path, instead of every glob in the profile. Permissions
+# from every matching rule are combined, the same way AppArmor does.
+class PathIndex:
+    def __init__(self):
+        self.literals = {}
+        self.root = _PathNode()
+        self.count = 0
+
+    def add(self, path, perms):
+        self.count += 1
+
+        if not isGlob(path):
+            if path in self.literals:
+                self.literals[path] = self.literals[path].union(perms)
+            else:
+                self.literals[path] = perms.copy()
+            return
+
+        prefix = literalPrefix(path)
+        node = self.root
+        for comp in prefix.split("/")[:-1]:
+            if comp == "":
+                continue
+            if comp not in node.children:
+                node.children[comp] = _PathNode()
+            node = node.children[comp]
+
+        node.globs.append((path, perms))
+
+    # Yields (pattern, perms) for every glob whose literal prefix leads to path
+    def candidates(self, path):
+        node = self.root
+        comps = path.split("/")
+        idx = 0
+        while node != None:
+            for entry in node.globs:
+                yield entry
+
+            # Globs can't be attached below a component that is itself a glob
+            while idx < len(comps) and comps[idx] == "":
+                idx += 1
+            if idx >= len(comps) or isGlob(comps[idx]):
+                break
+            node = node.children.get(comps[idx])
+            idx += 1
+
+    def lookup(self, path):
+        perms = FilePermissions()
+
+        if path in self.literals:
+            perms.update(self.literals[path])
+
+        for pattern, gperms in self.candidates(path):
+            if globCovers(pattern, path):
+                perms.update(gperms)
+
+        return perms
+
+    def covers(self, path, perms):
+        if self.count == 0:
+            return False
+
+        return self.lookup(path).covers(perms)
+
+    def __len__(self):
+        return self.count
@@ -18,6 +18,7 @@ from .ProfileTypes import *
 from .Filter import *
 import re
 from .LogTypes import *
+from .Metrics import *
 
 class ParseAppArmorMessage:
     time_regex = r'\[\s+(\d+\.\d+)\]'
@@ -121,6 +122,9 @@ class ParseAppArmorMessage:
 
         return True
 
+#
+# rules holds the default rule of every entry in objlist, so duplicate checks are a
+# set lookup rather than a scan of the list
 class ProcessRuleList:
     objlist = []
     name = ""
@@ -128,18 +132,22 @@ class ProcessRuleList:
     def __init__(self, name):
         self.name = name
         self.objlist = []
+        self.rules = set()
 
         return
 
-    def addObj(self, obj):
+    def addObj(self, obj, rule=None):
+        if rule == None:
+            rule = obj.getDefaultRule()
+
         self.objlist.append(obj)
+        self.rules.add(rule)
 
     def isDuplicate(self, obj):
          # First the easy way, is the same rule in place?
-         for rule in self.objlist:
-             if rule.getDefaultRule() == obj.getDefaultRule():
-                 # Duplicate rule
-                 return True
+         if obj.getDefaultRule() in self.rules:
+             # Duplicate rule
+             return True
          # No rule duplicate, see if we have other duplicates via the obj handlers
          # XXX This doesn't work yet, it needs to refer back to the whole list
          for rule in self.objlist:
@@ -150,10 +158,15 @@ class ProcessRuleList:
 
 #
 # Primary front end for parsing log files
+#
+# profile_names is a dict used as an ordered set so membership checks stay O(1)
+# on large logs. resolver, when set, maps normalized log names back to loaded
+# profile names (see ProfileParser.resolveName())
 class LogParser:
-    def __init__(self):
-        self.profile_names = []
+    def __init__(self, resolver=None):
+        self.profile_names = {}
         self.entries = {}
+        self.resolver = resolver
 
     #
     # We keep this here, because it is used for key lookup in the tables below.
@@ -171,12 +184,35 @@ class LogParser:
 
          return profile_name[:idx].lstrip("/.")
 
+    def resolveProfileName(self, profile_name):
+        norm_name = self.normalizeProfileName(profile_name)
+
+        if self.resolver:
+            return self.resolver(norm_name)
+
+        return norm_name
+
+    def addName(self, name):
+        if name not in self.profile_names:
+            self.profile_names[name] = True
+
+    def hasName(self, name):
+        return name in self.profile_names
+
     def getObj(self, key):
         return self.entries[key].objlist
 
     def parseLogfile(self, fi):
          with open(fi) as f:
-             log_data = set(f.readlines())
+             lines = f.readlines()
+         line_count = len(lines)
+         log_data = set(lines)
+         del lines
+
+         # Counted locally and added to the metrics once at the end
+         matched = 0
+         duplicates = 0
+         types = {}
 
          for message in log_data:
              aa_msg = ParseAppArmorMessage(message) # each log line.
@@ -185,12 +221,15 @@ class LogParser:
              if not obj:
                  continue # Do nothing
 
+             matched += 1
+             obj_type = type(obj).__name__
+             types[obj_type] = types.get(obj_type, 0) + 1
+
              #
              # Handle per-process list appends
-             norm_name = self.normalizeProfileName(obj.profile)
+             norm_name = self.resolveProfileName(obj.profile)
              # If no name exists, create it
-             if norm_name not in self.profile_names:
-                 self.profile_names.append(norm_name)
+             self.addName(norm_name)
 
              #
              # Now add the rule list entry
@@ -199,14 +238,26 @@ class LogParser:
 
             #
             # Now add the actual rule object itself
-             if not self.isDuplicate(obj, self.entries[norm_name]):
-                 self.entries[norm_name].addObj(obj)
+             rule = obj.getDefaultRule()
+             if rule not in self.entries[norm_name].rules:
+                 self.entries[norm_name].addObj(obj, rule)
+             else:
+                 duplicates += 1
 
              if hasattr(obj, 'getComment') and callable(hasattr(obj, 'getComment')):
                  self.entries[norm_name].addObj(obj.getComment())
 
+         GlobalMetrics.lines_read.inc(line_count)
+         GlobalMetrics.lines_matched.inc(matched)
+         GlobalMetrics.dedup_hits.inc(line_count - len(log_data), ("line",))
+         GlobalMetrics.dedup_hits.inc(duplicates, ("entry",))
+         for obj_type, count in types.items():
+             GlobalMetrics.log_objects.inc(count, (obj_type,))
+
+         return line_count
+
     def getNameList(self):
-        return self.profile_names
+        return list(self.profile_names)
     def getObjList(self, name):
         if name in self.entries:
             return self.entries[name].objlist
@@ -214,12 +265,7 @@ class LogParser:
             return None
 
     def isDuplicate(self, obj, rl):
-        # First the easy way, is the same rule in place?
-        for rule in rl.objlist:
-            if rule.getDefaultRule() == obj.getDefaultRule():
-                # Duplicate rule
-                return True
-        return False
+        return obj.getDefaultRule() in rl.rules
 
     def SortLogList(self, profile_name):
         sortd = {}
@@ -16,9 +16,28 @@
 
 import re
 from .Filter import *
+from .Permissions import *
+from .Capabilities import *
+from .Metrics import *
+from .Util import *
 import sys
 import os
 
+# LogTypesFilter as [(compiled pattern, replacement)], see getLogFilters()
+_log_filters = None
+
+#
+# getDefaultRule() runs the filters for every file entry, so they are loaded and
+# compiled once
+def getLogFilters():
+    global _log_filters
+
+    if _log_filters == None:
+        filters = Filter("LogTypesFilter").loadFilterSet()
+        _log_filters = [(re.compile(f), filters[f]) for f in filters]
+
+    return _log_filters
+
 class base_op:
     action = ""
     operation = ""
@@ -59,10 +78,14 @@ class base_op:
              self.comm = parsed_dict["comm"]
 
     def isDuplicate(self):
-        print("WARNING: Pure virtual call to base_op: isDuplicate")
+        GlobalLogger.warning("Pure virtual call to base_op: isDuplicate")
         return False
 
 # Capabilities
+#
+# The kernel logs both the capability number and name, we keep the number as an
+# int (see Capabilities.cap_table) and the name without quotes, so comparing
+# and merging don't need any string handling
 class OpCapable(base_op):
     capability = -1
     capname = ""
@@ -78,9 +101,17 @@ class OpCapable(base_op):
         base_op.parse(self, parsed_dict)
 
         if ("capability" in parsed_dict) and parsed_dict["capability"]:
-            self.capability = parsed_dict["capability"]
+            try:
+                self.capability = int(parsed_dict["capability"].strip("\""))
+            except ValueError:
+                self.capability = -1
         if ("capname" in parsed_dict) and parsed_dict["capname"]:
-            self.capname = parsed_dict["capname"]
+            self.capname = parsed_dict["capname"].strip("\"")
+
+        if not self.capname and capName(self.capability):
+            self.capname = capName(self.capability)
+        elif self.capname and self.capability == -1:
+            self.capability = capNumber(self.capname)
 
         return True
 
@@ -99,25 +130,32 @@ class OpCapable(base_op):
 
     def getDefaultRule(self):
         if self.capname:
-            return "capability " + self.capname.strip("\"")
+            return "capability " + self.capname
 
         if self.name:
             return "capability " + self.name.strip("\"")
 
+    def getCapability(self):
+        return self.capability
+
+    def getRuleKey(self):
+        if self.capability != -1:
+            return self.capability
+        return self.capname
+
     def __hash__(self):
-        return hash(("capability ", self.capname.strip("\"")))
+        return hash(("capability ", self.getRuleKey()))
 
     def __eq__(self, rule):
-        return isinstance(rule, OpCapable) and \
-                self.capname.strip("\"") == rule.capname.strip("\"")
+        return isinstance(rule, OpCapable) and self.getRuleKey() == rule.getRuleKey()
 
     def __lt__(self, rule):
-        return ((self.capname.strip("\"").lower(), self.capability) <
-                (rule.capname.strip("\"").lower(), rule.capability))
+        return ((self.capname.lower(), self.capability) <
+                (rule.capname.lower(), rule.capability))
 
     def __repr__(self):
         # XXX I guess this would replace "getDefaultRule"?
-        return 'capability ' + self.capname.strip("\"")
+        return 'capability ' + self.capname
 
 # File accesses
 class OpFile(base_op):
@@ -126,10 +164,12 @@ class OpFile(base_op):
     fsuid = -1
     ouid = -1
     handled = False
+    filtered = False
 
     priority = 10
     def __init__(self):
         base_op.__init__(self)
+        self.perms = None
 
         return
 
@@ -154,51 +194,64 @@ class OpFile(base_op):
     def checkFilters(self, rule):
         new_rule = rule
 
-        f = Filter("LogTypesFilter")
-        filters = f.loadFilterSet()
-
         # Ok, this gets messy. We assuem each filter has at least two regex patterns: the
         # pattern to match and replace, followed by a .*. We use the second one to append
         # any subsequent portions of the path. We can stack multiple filters this way,
         # but it's messy...XXX find a better way
 
-        for f in filters:
-            p = re.compile(f)
+        for p, replacement in getLogFilters():
             m = p.match(rule)
 
             if m:
-               new_rule = filters[f] + m.groups()[1]
+               new_rule = replacement + m.groups()[1]
+
+               # getDefaultRule() is called many times per entry, only count it once
+               if not self.filtered:
+                   self.filtered = True
+                   GlobalMetrics.filter_rewrites.inc()
 
         return new_rule
 
 
-    def getDefaultRule(self):
+    #
+    # Permissions are parsed from the log mask once, then merged as a bitmask during
+    # de-duplication (see Permissions.FilePermissions)
+    def getPermissions(self):
+        if self.perms != None:
+            return self.perms
+
         mask = ""
         if not self.requested_mask:
             #print("No requested_mask for rule, trying denied mask")
             if not self.denied_mask:
-                print("No denied or requested mask, using default")
+                GlobalLogger.warning("No denied or requested mask, using default")
                 mask = "rw"
             else:
                 mask = self.denied_mask
         else:
             mask = self.requested_mask
 
+        self.perms = FilePermissions.fromLogMask(mask)
+        return self.perms
+
+    def getDefaultRule(self):
+        perms = self.getPermissions()
+
         if not self.name:
-            print("No name for rule, returning empty rule")
+            GlobalLogger.warning("No name for rule, returning empty rule")
             return ""
 
-        # We have to transform certain masks to 'w', like 'd' and 'c', since they don't map
-        # directly to AppArmor profile permissions
-        cur_mask = mask.replace("\"", "")
-        cur_mask = cur_mask.strip(",") # Just in case
+        self.getPath()
 
-        cur_mask = cur_mask.replace("c", "w")
-        cur_mask = cur_mask.replace("d", "w")
+        rule = self.name + " " + perms.render()
+        rule = self.checkFilters(rule)
 
-        if 'a' in cur_mask and 'w' in cur_mask:
-            cur_mask = cur_mask.replace("a", "w")
+        return rule
 
+    #
+    # Normalizes self.name into the path used for the profile rule, this is
+    # also the canonical identity of the entry (see getRuleKey())
+    def getPath(self):
         self.name = self.name.strip("\"")
 
         # There are weird cases where the names are hex encoded, this doesn't work
@@ -209,28 +262,13 @@ class OpFile(base_op):
         if '/' not in self.name:
             self.name = '/' + self.name
 
-        # Now handle each possible permission
-        new_mask = ""
-        mask_chars = ['r', 'w', 'l', 'k', 'x', 'm', 'i']
-        for c in mask_chars:
-            if c in cur_mask:
-                cur_mask = cur_mask.replace(c, '')
-                if c == 'i':
-                    # Do nothing since 'x' will handle this
-                    c = ''
-                if c == 'x':
-                    c = 'ix'
-                new_mask += c
-        new_mask += cur_mask # This handles unknowns
-
-
         if ".so" in self.name:
             self.name = self.fixLibraryVersions(self.name)
 
-        rule = (self.name).strip("\"") + " " + new_mask
-        rule = self.checkFilters(rule)
+        return self.name
 
-        return rule
+    def getRuleKey(self):
+        return self.getPath()
 
     # Ideally we'd use filters here, but that would require some group stuff that
     # currently isn't supported (TODO)
@@ -258,10 +296,7 @@ class OpFile(base_op):
             lib_path = filename[:filename.rfind('/') + 1]
 
         else:
-            print("ERROR: Could not find / in lib path name")
-            print("-> Original filename: ")
-            print(filename)
-            sys.exit(0)
+            GlobalLogger.fatal("Could not find / in lib path name\n-> Original filename: %s", filename)
 
         new_rule = ""
         new_rule += lib_path
@@ -275,10 +310,7 @@ class OpFile(base_op):
                 base_libname = m.groups()[0]
                 new_rule += base_libname + "-*"
             else:
-                print("ERROR: fixLibraryVersions() invalid regex version string match")
-                print("-> Original filename: ")
-                print(filename)
-                sys.exit(0)
+                GlobalLogger.fatal("fixLibraryVersions() invalid regex version string match\n-> Original filename: %s", filename)
         else:
             # No version string, just use the library name
             new_rule += lib_name[:lib_name.rfind('.so')]
@@ -295,12 +327,11 @@ class OpFile(base_op):
         # This can happen if there is a bug here or a format we do not expect, it's not
         # very likely, but is possible and it's safer to exit
         if new_rule == "/lib*.so*":
-            print("ERROR: fixLibraryVersions() created an invalid entry due to a bug")
-            print("-> Original filename: ")
-            print(filename)
-            print("Please submit the filename above as a bug report with this error.")
-            sys.exit(0)
+            GlobalLogger.fatal("fixLibraryVersions() created an invalid entry due to a bug\n-> Original filename: %s\n"
+                               "Please submit the filename above as a bug report with this error.", filename)
 
+        if new_rule != filename:
+            GlobalMetrics.library_normalizations.inc(1, ("log",))
         return new_rule
 
     def isType(self, parsed_dict):
@@ -343,7 +374,8 @@ class OpFile(base_op):
         return hash(((self.name).strip("\""), self.requested_mask.strip("\"")))
 
     def __eq__(self, rule):
-        return ((self.name.lower(), self.requested_mask.lower()) ==
+        return isinstance(rule, OpFile) and \
+                ((self.name.lower(), self.requested_mask.lower()) ==
                 (rule.name.lower(), rule.requested_mask.lower()))
 
     def __lt__(self, rule):
@@ -352,7 +384,7 @@ class OpFile(base_op):
 
     def __repr__(self):
         # XXX I guess this would replace "getDefaultRule"?
-        return (self.name).strip("\"") + " " + self.requested_mask.strip("\"")
+        return (self.name).strip("\"") + " " + self.getPermissions().render()
 
 # v2 Networking
 class OpNetwork(base_op):
@@ -405,6 +437,9 @@ class OpNetwork(base_op):
         opc.comment = f"# NETCOM - {self.family} {self.sock_type} {self.operation}"
         return opc
 
+    def getRuleKey(self):
+        return (self.family.strip("\""), self.sock_type.strip("\""))
+
     def __hash__(self):
         return hash(self.family.strip("\""))
 
@@ -439,6 +474,9 @@ class OpComment(base_op):
     def getDefaultRule(self):
         return self.comment.strip("\"")
 
+    def getRuleKey(self):
+        return self.getDefaultRule()
+
     def __hash__(self):
         return hash(self.comment)
 
@@ -476,6 +514,9 @@ class OpPtrace(base_op):
     def getDefaultRule(self): # XXX with __repr__ maybe we can remove this.
         return "ptrace"
 
+    def getRuleKey(self):
+        return "ptrace"
+
     def __hash__(self):
         return hash(("ptrace"))
 
@@ -528,6 +569,9 @@ class OpSignal(base_op):
     def getDefaultRule(self):
         return "signal"
 
+    def getRuleKey(self):
+        return "signal"
+
     def __hash__(self):
         return hash(("signal"))
 
@@ -0,0 +1,272 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import tempfile
+import threading
+
+from .OutputWriter import getUmask
+
+#
+# A counter, with a value for each combination of label values
+#   rules.inc(3, ("OpFile",))
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount=1, label_values=()):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        return list(self.values.items())
+
+    def merge(self, values):
+        for label_values, value in values:
+            self.inc(value, tuple(label_values))
+
+#
+# A histogram with fixed upper bounds, each label combination keeps a count per bucket
+# plus the sum and count of everything observed
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, label_values=()):
+        cur = self.values.get(label_values)
+        if cur == None:
+            # [bucket counts..., +Inf count, sum]
+            cur = [0] * (len(self.buckets) + 2)
+            self.values[label_values] = cur
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                cur[i] += 1
+                break
+        else:
+            cur[len(self.buckets)] += 1
+        cur[-1] += value
+
+    def snapshot(self):
+        return [(label_values, list(cur)) for label_values, cur in list(self.values.items())]
+
+    def merge(self, values):
+        for label_values, other in values:
+            label_values = tuple(label_values)
+            cur = self.values.get(label_values)
+            if cur == None:
+                self.values[label_values] = list(other)
+                continue
+            for i in range(len(cur)):
+                cur[i] += other[i]
+
+#
+# Holds a run's metrics and exports them as a Prometheus textfile (for the node_exporter
+# textfile collector) or JSON
+#
+# Updates don't take a lock, they're plain dict updates. Exporting from another thread
+# copies each metric's values first, so an export may be slightly behind but never fails.
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.values = {}
+
+    #
+    # Returns the values gathered so far and starts over, used to ship metrics from
+    # worker processes to the parent, which adds them with merge()
+    def takeSnapshot(self):
+        snap = {}
+        for name, metric in self.metrics.items():
+            if metric.values:
+                snap[name] = metric.snapshot()
+        self.reset()
+        return snap
+
+    def merge(self, snap):
+        for name, values in snap.items():
+            self.metrics[name].merge(values)
+
+    def toPrometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+            for label_values, value in metric.snapshot():
+                labels = formatLabels(metric.labels, label_values)
+                if metric.kind == "counter":
+                    lines.append(f"{metric.name}{labels} {formatValue(value)}")
+                    continue
+
+                total = 0
+                for bound, count in zip(metric.buckets + ["+Inf"], value[:-1]):
+                    total += count
+                    le = formatLabels(metric.labels + ("le",), label_values + (formatValue(bound),))
+                    lines.append(f"{metric.name}_bucket{le} {str(total)}")
+                lines.append(f"{metric.name}_sum{labels} {formatValue(value[-1])}")
+                lines.append(f"{metric.name}_count{labels} {str(total)}")
+
+        return "\n".join(lines) + "\n"
+
+    def toDict(self):
+        out = {}
+        for metric in self.metrics.values():
+            values = []
+            for label_values, value in metric.snapshot():
+                entry = {"labels": dict(zip(metric.labels, label_values))}
+                if metric.kind == "counter":
+                    entry["value"] = value
+                else:
+                    entry["buckets"] = dict(zip([formatValue(b) for b in metric.buckets] + ["+Inf"], value[:-1]))
+                    entry["sum"] = value[-1]
+                    entry["count"] = sum(value[:-1])
+                values.append(entry)
+
+            out[metric.name] = {"type": metric.kind, "help": metric.help, "values": values}
+
+        return out
+
+    # The textfile collector may read at any time, so both exports are written to a
+    # temporary file and renamed into place
+    def writeTextfile(self, path):
+        writeAtomic(path, self.toPrometheus())
+
+    def writeJSON(self, path):
+        writeAtomic(path, json.dumps(self.toDict(), indent=1) + "\n")
+
+# Returns {name="value",...}, or nothing for metrics without labels
+def formatLabels(names, values):
+    if not names:
+        return ""
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{name}=\"{value}\"")
+    return "{" + ",".join(pairs) + "}"
+
+def formatValue(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def writeAtomic(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".metrics")
+    try:
+        # mkstemp() creates the file 0600, the node exporter and other readers need the
+        # mode open() would have used
+        os.fchmod(fd, 0o666 & ~getUmask())
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+#
+# The metrics updated throughout the pipeline
+class PipelineMetrics(MetricsRegistry):
+    rule_buckets = [0, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+    duration_buckets = [0.0001, 0.001, 0.01, 0.1, 1, 10, 60, 600]
+
+    def __init__(self):
+        super().__init__()
+
+        self.lines_read = self.counter("macpolicyparse_log_lines_read_total", "Log lines read")
+        self.lines_matched = self.counter("macpolicyparse_log_lines_matched_total",
+                                          "Unique log lines parsed into an AppArmor log entry")
+        self.log_objects = self.counter("macpolicyparse_log_objects_total",
+                                        "AppArmor log entries by type", ("type",))
+        self.dedup_hits = self.counter("macpolicyparse_dedup_hits_total",
+                                       "Entries dropped as duplicates (line: identical log lines, entry: same "
+                                       "rule in the log, merge: merged into a rule of the profile)", ("stage",))
+        self.filter_rewrites = self.counter("macpolicyparse_filter_rewrites_total",
+                                            "Log file rules rewritten by LogTypesFilter")
+        self.library_normalizations = self.counter("macpolicyparse_library_normalizations_total",
+                                                   "Shared library paths with the version replaced by a wildcard",
+                                                   ("source",))
+        self.profiles_emitted = self.counter("macpolicyparse_profiles_emitted_total",
+                                             "Profiles in the output", ("source",))
+        self.profile_rules = self.histogram("macpolicyparse_profile_rules",
+                                            "Rules in each generated profile", self.rule_buckets)
+        self.violations = self.counter("macpolicyparse_security_violations_total",
+                                       "Security check violations", ("check",))
+        self.stage_duration = self.histogram("macpolicyparse_stage_duration_seconds",
+                                             "Wall time of each run of a pipeline stage, see RunProfiler",
+                                             self.duration_buckets, ("stage",))
+
+GlobalMetrics = PipelineMetrics()
+
+#
+# Writes the registry's exports every interval seconds from a background thread, so
+# a long run can be watched while it's going, and once more on stop()
+class MetricsExporter:
+    def __init__(self, registry, textfile=None, json_path=None, interval=None):
+        self.registry = registry
+        self.textfile = textfile
+        self.json_path = json_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def export(self):
+        if self.textfile:
+            self.registry.writeTextfile(self.textfile)
+        if self.json_path:
+            self.registry.writeJSON(self.json_path)
+
+    def start(self):
+        if not self.interval:
+            return
+
+        self.thread = threading.Thread(target=self.run, name="MetricsExporter", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+        self.export()
@@ -0,0 +1,171 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from .Permissions import *
+from .Glob import *
+from .ProfileTypes import *
+from .LogTypes import *
+
+#
+# Whole-profile rule minimization, run on the OutputProfile rule list before the
+# security checks, so the rules that are checked are the ones emitted. Generated profiles end up with rules that are redundant with each other,
+# this reduces them to a smaller equivalent set:
+#
+#   - Identical rules are only kept once
+#   - File rules for the same path are merged into one rule (/a r + /a rw -> /a rw)
+#   - Literal file rules granted by the globs in the same profile are dropped
+#   - Glob file rules granted by a single other glob are dropped
+#
+# A rule with exec permissions is only dropped for a glob with the same exec
+# transition (ix, px, cx, ...). Otherwise dropping it would change how the file is
+# executed, e.g. /usr/bin/foo ix under /usr/bin/* px.
+#   - The same is done for the rules within each subprofile
+#
+# Subprofile rules are not compared against the parent, a child profile doesn't
+# inherit anything from the profile it's declared in.
+
+# Returns (path, perms) for simple file rules, None otherwise
+def parseFileRule(rule):
+    tokens = rule.split()
+    if len(tokens) != 2 or not tokens[0].startswith("/"):
+        return None
+
+    return tokens[0], FilePermissions.fromProfile(tokens[1])
+
+# True if the globs in index covering path grant exec with the same transition as
+# perms, and none of them with another one
+def execCovered(index, path, perms):
+    mode = perms.execMode()
+    found = False
+    for pattern, gperms in index.candidates(path):
+        if pattern == path or not gperms.hasExec() or not globCovers(pattern, path):
+            continue
+        if gperms.execMode() != mode:
+            return False
+        found = True
+    return found
+
+#
+# Minimizes a list of (rule string, raw object) pairs, returns the new list
+def minimizeRules(rules):
+    seen = set()
+    files = {}
+    out = []
+
+    # Hashed identity, and merge file rules on the same path
+    for rule, obj in rules:
+        if rule in seen:
+            continue
+        seen.add(rule)
+
+        fr = parseFileRule(rule)
+        if fr == None:
+            out.append([rule, obj, None])
+            continue
+
+        path, perms = fr
+        if path in files:
+            files[path][2][1].update(perms)
+            continue
+
+        entry = [rule, obj, (path, perms)]
+        files[path] = entry
+        out.append(entry)
+
+    index = PathIndex()
+    globs = []
+    for entry in files.values():
+        path, perms = entry[2]
+        if isGlob(path):
+            index.add(path, perms)
+            globs.append(entry)
+
+    dropped = set()
+
+    # Globs covered by a single other glob
+    for entry in globs:
+        path, perms = entry[2]
+        for pattern, gperms in index.candidates(path):
+            if pattern != path and globCovers(pattern, path) and gperms.covers(perms):
+                if perms.hasExec() and not execCovered(index, path, perms):
+                    break
+                dropped.add(path)
+                break
+
+    # Literals covered by the globs (union of their permissions)
+    if globs:
+        for path, entry in files.items():
+            perms = entry[2][1]
+            if isGlob(path) or not index.covers(path, perms):
+                continue
+            if perms.hasExec() and not execCovered(index, path, perms):
+                continue
+            dropped.add(path)
+
+    result = []
+    for rule, obj, fr in out:
+        if fr != None:
+            path, perms = fr
+            if path in dropped:
+                continue
+            rule = path + " " + perms.render()
+            # Merged permissions need to end up in the object, the subprofile rules are
+            # rendered from it and the security checks read it
+            if isinstance(obj, (FileRule, OpFile)):
+                obj.perms = perms
+        result.append((rule, obj))
+
+    return result
+
+# Minimizes the rules within a subprofile, returns the number of rules removed
+def minimizeSubprofile(tp):
+    rules = [(r.getDefaultRule(), r) for r in tp.profile_ruleobjs]
+    new_rules = minimizeRules(rules)
+
+    if len(new_rules) == len(rules):
+        return 0
+
+    tp.profile_ruleobjs = [obj for rule, obj in new_rules]
+    return len(rules) - len(new_rules)
+
+#
+# Minimizes the rules of an OutputProfile in place, returns the number of rules
+# that were eliminated
+def minimizeProfile(op):
+    eliminated = 0
+    rules = []
+
+    for rule in op.rule_list:
+        obj = op.raw_dict.get(rule)
+
+        if isinstance(obj, TransitionProfileRule):
+            removed = minimizeSubprofile(obj)
+            if removed:
+                eliminated += removed
+                rule = obj.getDefaultRule()
+
+        rules.append((rule, obj))
+
+    new_rules = minimizeRules(rules)
+    eliminated += len(rules) - len(new_rules)
+
+    op.rule_list = []
+    op.raw_dict = {}
+    for rule, obj in new_rules:
+        op.rule_list.append(rule)
+        op.raw_dict[rule] = obj
+
+    return eliminated
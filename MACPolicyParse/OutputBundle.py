@@ -0,0 +1,127 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+
+from .OutputWriter import getUmask
+
+#
+# Single file output for the generated profiles
+#
+# Profiles are streamed into the bundle as they're generated in one sequential pass,
+# nothing but the current profile is kept in memory. The format comes from the
+# filename:
+#
+#   .tar, .tar.gz/.tgz, .tar.xz/.txz - A (compressed) tar of the profile files
+#   anything else - The profiles concatenated into one policy file, which
+#     apparmor_parser can load as is, along with a <bundle>.idx JSON index giving
+#     the offset, length and sha256 of each profile in it
+#
+# The bundle is written under a temporary name and renamed into place by close(), so
+# an interrupted run never leaves a partial bundle behind. Same write()/close()
+# interface as OutputWriter.
+class OutputBundle:
+    tar_formats = {
+        ".tar": "",
+        ".tar.gz": "gz",
+        ".tgz": "gz",
+        ".tar.xz": "xz",
+        ".txz": "xz",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.compression = None
+        for ext, compression in self.tar_formats.items():
+            if path.endswith(ext):
+                self.compression = compression
+
+        self.index = []
+        self.offset = 0
+        self.mtime = int(time.time())
+
+        bundle_dir = os.path.dirname(os.path.abspath(path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=bundle_dir, prefix="." + os.path.basename(path))
+        os.fchmod(fd, 0o666 & ~getUmask())
+        self.fp = os.fdopen(fd, "wb")
+
+        self.tar = None
+        if self.compression != None:
+            self.tar = tarfile.open(fileobj=self.fp, mode="w|" + self.compression)
+
+    @staticmethod
+    def isTarPath(path):
+        return any(path.endswith(ext) for ext in OutputBundle.tar_formats)
+
+    def isTar(self):
+        return self.tar != None
+
+    def write(self, filename, content):
+        data = content.encode()
+
+        if self.tar:
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            self.tar.addfile(info, io.BytesIO(data))
+            self.index.append({"filename": filename, "size": len(data)})
+            return
+
+        # Keep each profile starting on its own line
+        if not data.endswith(b"\n"):
+            data += b"\n"
+
+        self.fp.write(data)
+        self.index.append({
+            "filename": filename,
+            "offset": self.offset,
+            "length": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        })
+        self.offset += len(data)
+
+    def abort(self):
+        if self.tar:
+            self.tar.close()
+        self.fp.close()
+        os.unlink(self.tmp_path)
+
+    # Finishes the bundle and moves it into place, returns (written, unchanged) like
+    # OutputWriter.close()
+    def close(self):
+        if self.tar:
+            self.tar.close()
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+
+        if not self.tar:
+            fd, tmp_index = tempfile.mkstemp(dir=os.path.dirname(self.tmp_path), prefix="." + os.path.basename(self.path))
+            os.fchmod(fd, 0o666 & ~getUmask())
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"bundle": os.path.basename(self.path), "profiles": self.index}, fp, indent=1)
+            os.replace(tmp_index, self.path + ".idx")
+
+        os.replace(self.tmp_path, self.path)
+
+        return [x["filename"] for x in self.index], []
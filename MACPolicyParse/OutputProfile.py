@@ -18,6 +18,21 @@ from .ProfileParser import *
 from .ProfileTypes import *
 from .RuleList import *
 from .SecurityCheck import *
+from .RuleStore import *
+from .PathTrie import *
+from .Minimize import *
+from .Fingerprint import *
+from .OutputWriter import *
+from .OutputBundle import *
+from .Diff import *
+from .Profiling import *
+from .Metrics import *
+from .Util import *
+import collections
+import concurrent.futures
+import hashlib
+import io
+import itertools
 import os
 
 class OutputProfile:
@@ -37,11 +52,24 @@ class OutputProfile:
 
         self.header = None
 
+        # Security violations found by SecurityCheck.checkProfile()
+        self.violations = []
+        # {rule: [violated check names]} from the last run, None when not cached
+        self.security_verdicts = None
+        # Rules removed by minimization
+        self.minimized = 0
+
+        # Stage timings, metrics and log messages from the worker process that built the
+        # profile, see RunProfiler, MetricsRegistry.takeSnapshot() and Logging.takeRecords()
+        self.stage_stats = None
+        self.metrics = None
+        self.log_records = None
+
     def getProfileStamp(self):
         now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
         return f'# Automated profile generated on {now}\n'
 
-    def getProfileHeader(self):
+    def getProfileHeader(self, log_default=True):
             if self.name == "" or self.exe_name == "":
                 # This shouldn't happen but the log files are potentially mangled
                 return ""
@@ -50,7 +78,8 @@ class OutputProfile:
             if isinstance(self.header, ProfileHeaderRule):
                 return self.header.getProfileHeader() + "\n"
 
-            print("Using default header for profile: " + self.name)
+            if log_default:
+                GlobalLogger.info("Using default header for profile: %s", self.name)
 
             return f"profile {self.name} {self.exe_name} flags=(complain) {{\n"
 
@@ -62,70 +91,222 @@ class OutputProfile:
     def getRuleList(self):
         return self.rule_list
 
-class OutputInclude:
-    def __init__(self, name, regex):
-        self.name = name
-        self.filename = ""
-        self.regex = regex
+    # Rough amount of work needed to build this profile
+    def getInputSize(self):
+        size = 0
+        if self.profile_entries:
+            size += len(self.profile_entries)
+        if self.log_entries:
+            size += len(self.log_entries)
+        return size
 
-        self.rule_list = []
-        self.keydict = {}
+#
+# Profile rules are rendered deepest path first, then alphabetically
+def ruleSortKey(rule):
+    return (-rule.count(os.path.sep), rule)
 
-        self.include_line = "include " + name
+#
+# Factors rules shared by several profiles out into include files
+#
+# Rules are grouped by the exact set of profiles that contain them, so every profile
+# that includes a file already had all of its rules and factoring never grants a
+# profile anything new. A group becomes an include file once at least min_support
+# profiles share it, it has at least min_size rules and moving it actually shrinks
+# the policy. Include files are named after a hash of their rules, so the same group
+# keeps the same file across runs.
+#
+# Everything is a single pass over the rule lists with dict lookups, the rewrite is
+# a set difference per profile.
+class OutputInclude:
+    def __init__(self, min_support=3, min_size=2, prefix="abstractions/macpolicyparse"):
+        self.min_support = min_support
+        self.min_size = min_size
+        self.prefix = prefix
 
-    def parseForIncludes(self, opl):
-        threshold = 3
-        include_rules = []
+        # Include filename -> sorted rule list, for every include file created
+        self.includes = {}
 
-        for op in opl:
-            for rule in op.getRuleList():
-                if rule in self.keydict:
-                    self.keydict[rule] += 1
-                else:
-                    self.keydict[rule] = 1
+    # Subprofiles, includes and comments stay in their profile
+    def isFactorable(self, rule):
+        return rule != "" and rule[0] != "#" and rule.split()[0] not in ("profile", "include")
 
-        for entry in self.keydict:
-            if self.keydict[entry] >= threshold:
-                include_rules.append(entry)
+    def getIncludeName(self, rules):
+        digest = hashlib.sha256("\n".join(rules).encode()).hexdigest()
+        return self.prefix + "/shared_" + digest[:12]
 
+    def parseForIncludes(self, opl):
+        profile_rules = []
+        counts = collections.Counter()
         for op in opl:
-            for entry in include_rules:
-                if entry in op.getRuleList():
-             #       print("Removing " + entry + " from " + op.name)
-                    op.rule_list.remove(entry) #XXX Make this official somehow
-                    if not self.include_line in op.getRuleList():
-                        op.rule_list.insert(0, self.include_line)
-                    op.include_count += 1
-
-            print(f"For profile {op.name} consolidated {str(op.include_count)} entries into include files")
-
-        return include_rules
+            rules = set(x for x in op.getRuleList() if self.isFactorable(x))
+            profile_rules.append(rules)
+            counts.update(rules)
+
+        # Rule -> indexes of the profiles that have it, only for rules that can make
+        # the support threshold. The rule sets are walked in sorted order so the groups,
+        # their rule order and the include files don't depend on set iteration order
+        # (PYTHONHASHSEED)
+        support = {}
+        for idx, rules in enumerate(profile_rules):
+            for rule in sorted(rules):
+                if counts[rule] >= self.min_support:
+                    support.setdefault(rule, []).append(idx)
+
+        groups = {}
+        for rule, profiles in support.items():
+            groups.setdefault(tuple(profiles), []).append(rule)
+
+        removed = [set() for op in opl]
+        for profiles, rules in sorted(groups.items()):
+            if len(rules) < self.min_size:
+                continue
+
+            # Each profile trades its copy of the rules for one include line, the
+            # include file itself adds the rules back once
+            if len(profiles) * (len(rules) - 1) <= len(rules):
+                continue
+
+            rules.sort(reverse=True, key=ruleSortKey)
+            name = self.getIncludeName(rules)
+            self.includes[name] = rules
+
+            for idx in profiles:
+                removed[idx].update(rules)
+                opl[idx].include_list.append("#include <" + name + ">")
+
+        total = 0
+        for op, rules in zip(opl, removed):
+            if not rules:
+                continue
+
+            # A profile from an earlier factored run may already include the file
+            op.include_list.sort()
+            rules.update(op.include_list)
+
+            op.rule_list = [x for x in op.rule_list if x not in rules]
+            for rule in rules:
+                op.raw_dict.pop(rule, None)
+            op.include_count += len(rules) - len(op.include_list)
+            total += len(rules) - len(op.include_list)
+
+            GlobalLogger.info("For profile %s consolidated %d entries into include files", op.name, op.include_count)
+
+        if self.includes:
+            GlobalLogger.info("Consolidated %d entries into %d include files", total, len(self.includes))
+
+        return self.includes
+
+    def renderInclude(self, name, fp):
+        fp.write("# Rules shared by several generated profiles\n")
+        for rule in self.includes[name]:
+            fp.write("    " + rule + ",\n")
 
 
+#
+# With lazy set, profiles are only parsed and regenerated when the logs have
+# entries for them or a rewrite was requested with requestRewrite(), the rest
+# are left untouched (see getUntouchedProfiles())
+#
+# With generalize set, file rules from the logs are collapsed into wildcards
+# once a directory has more than that many entries (see PathTrie)
+#
+# With minimize set, redundant rules are removed from each profile before it is
+# security checked (see Minimize)
+#
+# With cache set to a Fingerprint.ProfileCache, unchanged profiles reuse their
+# output from the last run
+#
+# With includes set to an OutputInclude, rules shared by several profiles are moved
+# into include files, which are output along with the profiles. This needs every
+# profile generated before any is output, and can't be combined with cache.
+#
+# With diff set, the rules of the existing profiles are captured before anything is
+# generated, for diffPolicyFile()
+#
+# With check_all set, security violations don't stop the run. Every profile is
+# checked, violations are collected in security_report (a SecurityCheck.SecurityReport)
+# and profiles with violations are left out of the output.
+#
+# With security_cache set to a Fingerprint.SecurityCache, only rules that are new or
+# changed since the last run are security checked
 class GenProfiles:
-    def __init__(self, rl=None):
+    def __init__(self, rl=None, lazy=False, generalize=None, minimize=True, cache=None, includes=None,
+                 check_all=False, security_cache=None, profiler=None, diff=False):
         if not rl:
-            self.rl = RuleList()
+            self.rl = RuleList(lazy=lazy)
         else:
             self.rl = rl
 
+        self.lazy = lazy
+        self.rewrite = set()
+        self.generalize = generalize
+        self.minimize = minimize
+        self.cache = cache
+        self.includes = includes
+        self.check_all = check_all
+        self.security = SecurityCheck(fail_fast=not check_all)
+
+        self.security_cache = security_cache
+        self.security_report = None
+        if check_all:
+            self.security_report = SecurityReport()
+
+        if profiler == None:
+            profiler = NullProfiler()
+        self.profiler = profiler
+
+        # Profile name -> (header, rules) parsed from the existing profile, see
+        # captureSourceRules()
+        self.diff = diff
+        self.source_rules = {}
+
+        if self.includes and self.cache:
+            GlobalLogger.warning("Profile cache disabled, it can't be used along with include files")
+            self.cache = None
+
+        self.dedup_handlers = {
+            OpFile: self.deDuplicate_File,
+            OpCapable: self.deDuplicate_Capability,
+            OpNetwork: self.deDuplicate_Keyed,
+            OpComment: self.deDuplicate_Keyed,
+            OpSignal: self.deDuplicate_Keyed,
+            OpPtrace: self.deDuplicate_Keyed,
+        }
+
     def ParseExistingProfiles(self, profile_path, skip):
-        self.rl.loadExistingProfiles(profile_path, skip)
+        with self.profiler.stage("Load profiles") as st:
+            st.items += self.rl.loadExistingProfiles(profile_path, skip)
 
     def ParseLogFile(self, path):
-        self.rl.parseLogfile(path)
+        with self.profiler.stage("Parse log") as st:
+            st.items += self.rl.parseLogfile(path)
 
     def GetLogEntriesForName(self, name):
-        return self
+        return self.rl.getLogObjList(name)
 
     def GetProfileEntriesForName(self, name):
-        return None
+        return self.rl.getProfileObjList(name)
+
+    # Forces regeneration of the given profile names in lazy mode
+    def requestRewrite(self, names):
+        for name in names:
+            self.rewrite.add(self.rl.resolveName(name))
+
+    # Profile objects that were never parsed, only set in lazy mode
+    def getUntouchedProfiles(self):
+        return self.rl.getUnloadedProfiles()
 
     def GetNames(self):
         nl = []
 
+        if self.lazy:
+            for pn in self.rl.getLogNames():
+                if self.rl.hasLogEntries(pn) or pn in self.rewrite:
+                    nl.append(pn)
+            return nl
+
         for pn in self.rl.getProfileNames():
-            if pn not in self.rl.getLogNames():
+            if not self.rl.hasLogName(pn):
                 nl.append(pn)
         for pn in self.rl.getLogNames():
             nl.append(pn)
@@ -140,11 +321,9 @@ class GenProfiles:
             op.filename = self.rl.getProfileFilename(op.name)
 
             if not op.exe_name:
-                print("**** MANUAL EDIT REQUIRED ****")
-                print("WARNING: No executable path found for profile name " + op.name)
-                print(" Using profile name as executable path.\n")
-                print(" Edit required: Change process path in the profile header to match exe path")
-                print("****************")
+                GlobalLogger.addManualEdit(op.name, "No executable path found for the profile, using the profile "
+                                           "name as executable path. Change the process path in the profile header "
+                                           "to match the exe path")
                 op.exe_name = op.name
 
             if op.filename == "" or op.filename == None:
@@ -152,106 +331,404 @@ class GenProfiles:
                 if op.filename and op.filename[0] == '.':
                     op.filename = op.filename[1:]
 
-                print("**** MANUAL EDIT REQUIRED ****")
-                print("WARNING: For profile name " + op.name + " profile filename had to be auto generated")
-                print(" the resulting file path may be incorrect, please verify the proper output file was used")
-                print(" Edit required: Verify the output profile name of " + op.filename + " is correct")
-                print("****************")
+                GlobalLogger.addManualEdit(op.name, "Profile filename had to be auto generated, the resulting "
+                                           "file path may be incorrect. Verify the output profile name of %s is "
+                                           "correct", op.filename)
+
+            if self.security_cache:
+                op.security_verdicts = self.security_cache.getProfile(op.name, op.exe_name)
     #
     # This initializes the list of OutputProfile objects, along with triggering duplicate
     # detections
-    def generateOutputProfiles(self):
-        opl = []
+    #
+    # With jobs > 1 the profiles are built in a process pool, see
+    # buildOutputProfilesParallel(). Results are returned in the same order as the
+    # serial path, so the output is identical.
+    def generateOutputProfiles(self, jobs=1, names=None):
+        return list(self.iterOutputProfiles(jobs, names))
 
-        for name in self.GetNames():
+    #
+    # Generator version of generateOutputProfiles(), profiles are built and handed
+    # out one at a time so callers don't need to keep all of them around
+    def iterOutputProfiles(self, jobs=1, names=None):
+        if names == None:
+            names = self.GetNames()
+
+        if jobs and jobs > 1 and len(names) > 1:
+            for op in self.buildOutputProfilesParallel(names, jobs):
+                if op.stage_stats:
+                    self.profiler.mergeStats(op.stage_stats)
+                    op.stage_stats = None
+                if op.metrics:
+                    GlobalMetrics.merge(op.metrics)
+                    op.metrics = None
+                if op.log_records:
+                    GlobalLogger.mergeRecords(op.log_records)
+                    op.log_records = None
+                self.cacheSecurityVerdicts(op)
+                yield op
+            return
+
+        for name in names:
             op = OutputProfile(name)
             self.initOutputProfile(op)
+            old = op.security_verdicts
+            op = self.buildOutputProfile(op)
+            self.cacheSecurityVerdicts(op, old)
+            yield op
 
-            # Now start accessing the rule lists themselves, starting with the profiles
-            # XXX Change this to use OP methods instead of the RL
-            profilelist = []
-            loglist = []
-
-            if self.rl.getProfileObjList(name):
-                profilelist = self.deDuplicate_Profile(self.rl.getProfileObjList(name))
-            if self.rl.getLogObjList(name):
-                loglist, profilelist = self.deDuplicate_Log(self.rl.getLogObjList(name), profilelist)
+    #
+    # Stores the verdicts from checking op in security_cache, old is what op was
+    # initialized with
+    def cacheSecurityVerdicts(self, op, old=None):
+        if self.security_cache == None or op.security_verdicts == None:
+            return
 
-            for entry in profilelist:
-                # Profile headers are a special case, we track it in the OP because the
-                # profile header may need to be regenerated during profile creation
-                if isinstance(entry, ProfileHeaderRule):
-                    op.header = entry
-                    continue
+        if old == None:
+            old = self.security_cache.getProfile(op.name, op.exe_name)
+        self.security_cache.putProfile(op.name, op.exe_name, op.security_verdicts, old)
 
-                op.addRule(entry.getDefaultRule(), entry)
+    #
+    # Builds the profiles in a pool of jobs worker processes and yields them in the
+    # order of names. At most window profiles (2 per worker by default) are in flight,
+    # each is set up right before it is submitted and a new one goes in as soon as the
+    # oldest is handed out, so only the window is held in memory at once.
+    def buildOutputProfilesParallel(self, names, jobs, window=None):
+        if window == None:
+            window = jobs * 2
+
+        names = iter(names)
+        pending = collections.deque()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker,
+                                                    initargs=(self.generalize, self.minimize, self.check_all,
+                                                              not isinstance(self.profiler, NullProfiler),
+                                                              GlobalLogger.level, GlobalLogger.buffered)) as ex:
+            for name in itertools.islice(names, window):
+                pending.append(self.submitOutputProfile(ex, name))
+
+            while pending:
+                future = pending.popleft()
+                # Keep the workers busy while the caller handles this one
+                name = next(names, None)
+                if name != None:
+                    pending.append(self.submitOutputProfile(ex, name))
+                yield future.result()
+
+    def submitOutputProfile(self, ex, name):
+        op = OutputProfile(name)
+        self.initOutputProfile(op)
+        return ex.submit(_buildWorker, op)
 
-            for entry in loglist:
-                op.addRule(entry.getDefaultRule(), entry)
+    #
+    # Dedups, builds and minimizes the rule list for a single OutputProfile from the
+    # entries set up by initOutputProfile(), then runs the security checks on it.
+    # Everything needed is in the OutputProfile, so this can run in a worker process.
+    def buildOutputProfile(self, op):
+        profilelist = []
+        loglist = []
+
+        with self.profiler.stage("Dedup") as st:
+            if op.profile_entries:
+                profilelist = self.deDuplicate_Profile(op.profile_entries)
+            if op.log_entries:
+                loglist, profilelist = self.deDuplicate_Log(op.log_entries, profilelist)
+            st.items += op.getInputSize()
+
+        if self.generalize and loglist:
+            with self.profiler.stage("Generalize") as st:
+                loglist, collapsed = generalizePaths(loglist, self.generalize)
+                st.items += len(loglist)
+            if collapsed:
+                GlobalLogger.info("For profile %s generalized %d file entries into wildcards", op.name, collapsed)
+
+        for entry in profilelist:
+            # Profile headers are a special case, we track it in the OP because the
+            # profile header may need to be regenerated during profile creation
+            if isinstance(entry, ProfileHeaderRule):
+                op.header = entry
+                continue
+
+            op.addRule(entry.getDefaultRule(), entry)
+
+        for entry in loglist:
+            op.addRule(entry.getDefaultRule(), entry)
+
+        # Minimization merges rules (/a w + /a ix -> /a wix), so it has to run before
+        # the checks see them
+        if self.minimize:
+            self.minimizeOutputProfile(op)
+
+        # XXX This could possibly be moved to occur prior to adding rules, but for now
+        # we just postprocess the entire profile.
+        with self.profiler.stage("Security checks") as st:
+            self.security.checkProfile(op)
+            st.items += len(op.rule_list)
+
+        return op
 
-            # XXX This could possibly be moved to occur prior to adding rules, but for now
-            # we just postprocess the entire profile.
-            sc = SecurityCheck()
-            sc.checkProfile(op)
+    #
+    # Options that change the generated output, these are part of the fingerprints
+    def getOptions(self):
+        return {"generalize": self.generalize, "minimize": self.minimize}
 
-            opl.append(op)
-        return opl
+    def fingerprintProfile(self, name, config_fp):
+        header = (name, self.rl.getProfileFilename(name), self.rl.getProfilePath(name))
+        return profileFingerprint(config_fp, header, self.rl.getProfileObjList(name), self.rl.getLogObjList(name))
 
     #
     # This should be the primary frontend, as it returns text profiles based on the OP list
-    def generatePolicyFileList(self):
+    def generatePolicyFileList(self, jobs=1):
+        return list(self.iterPolicyFiles(jobs))
+
+    #
+    # Yields {"name", "filename", "profile", "op"} dicts one profile at a time, in the
+    # same order as generatePolicyFileList(). name is None for include files, op is
+    # None for include files and profiles reused from the cache.
+    def iterPolicyFiles(self, jobs=1):
+        for name, filename, op, text in self.iterRenderedProfiles(jobs):
+            if op != None:
+                text = self.renderText(op)
+
+            yield {"name": name, "filename": filename, "profile": text, "op": op}
+
+    #
+    # Renders a generated profile to a string
+    def renderText(self, op):
+        with self.profiler.stage("Render") as st:
+            buf = io.StringIO()
+            self.renderProfile(op, buf)
+            st.items += 1
+
+        return buf.getvalue()
+
+    #
+    # Renders each profile and hands it to an OutputWriter for path, which only
+    # rewrites files whose content changed and renames them into place. Generated
+    # profiles are hashed as they are rendered, so the writer compares them without
+    # another pass, and it writes them out on its thread pool.
+    #
+    # If no writer is passed, one with the default settings is used, closed here and
+    # its (written, unchanged) filename lists returned. Otherwise closing the writer is
+    # left to the caller, anything with the same write() interface can be passed (e.g.
+    # an OutputBundle, which needs each profile's size up front and so is handed the
+    # rendered text instead).
+    def writePolicyFiles(self, path, jobs=1, writer=None):
+        own_writer = writer == None
+        if own_writer:
+            writer = OutputWriter(path)
+
+        stream = hasattr(writer, "writeStream")
+
+        for name, filename, op, text in self.iterRenderedProfiles(jobs):
+            if op == None:
+                writer.write(filename, text)
+            elif stream:
+                with self.profiler.stage("Render") as st:
+                    writer.writeStream(filename, lambda fp: self.renderProfile(op, fp))
+                    st.items += 1
+            else:
+                writer.write(filename, self.renderText(op))
+
+        if own_writer:
+            return writer.close()
+
+    #
+    # Streams every profile into a single tar or concatenated policy bundle at path,
+    # see OutputBundle. Returns the filenames written to it.
+    def writePolicyBundle(self, path, jobs=1):
+        bundle = OutputBundle(path)
+
+        try:
+            self.writePolicyFiles(path, jobs, bundle)
+        except BaseException:
+            bundle.abort()
+            raise
+
+        return bundle.close()[0]
+
+    #
+    # Common driver for the output frontends, yields (name, filename, op, text) for each
+    # profile. Either op is a generated OutputProfile that still needs rendering, or
+    # op is None and text is the output reused from the cache.
+    #
+    # With a ProfileCache set, profiles whose fingerprint matches the last run reuse
+    # the previous output and are not regenerated or re-checked
+    def iterRenderedProfiles(self, jobs=1):
+        names = self.GetNames()
+        fingerprints = {}
+        cached = {}
+
+        if self.diff:
+            self.captureSourceRules(names)
+
+        if self.cache:
+            with self.profiler.stage("Fingerprint") as st:
+                config_fp = configFingerprint(self.getOptions())
+                for name in names:
+                    fingerprints[name] = self.fingerprintProfile(name, config_fp)
+                    entry = self.cache.get(name, fingerprints[name])
+                    if entry:
+                        cached[name] = entry
+                st.items += len(names)
+
+            GlobalLogger.info("Reusing %d of %d profiles from the last run", len(cached), len(names))
+
+        generated = self.iterOutputProfiles(jobs, [n for n in names if n not in cached])
+        eliminated = 0
+
+        if self.includes:
+            yield from self.iterFactoredProfiles(names, generated)
+            self.saveSecurityCache()
+            return
+
+        for name in names:
+            if name in cached:
+                entry = cached[name]
+                if self.cache:
+                    self.cache.put(name, fingerprints[name], entry)
+                # Profiles with violations are never cached, so these passed
+                self.reportViolations(name, self.rl.getProfilePath(name), [])
+                GlobalMetrics.profiles_emitted.inc(1, ("cached",))
+                yield name, entry["filename"], None, entry["profile"]
+                continue
+
+            op = next(generated)
+
+            if self.reportViolations(name, op.exe_name, op.violations):
+                continue
+
+            eliminated += op.minimized
+            self.countProfile(op)
+            filename = self.getOutputFilename(op)
+
+            if self.cache:
+                with self.profiler.stage("Render") as st:
+                    buf = io.StringIO()
+                    self.renderProfile(op, buf)
+                    st.items += 1
+                self.cache.put(name, fingerprints[name], {"filename": filename, "profile": buf.getvalue()})
+                yield name, filename, None, buf.getvalue()
+                continue
+
+            yield name, filename, op, None
+
+        self.reportMinimized(eliminated)
+
+        if self.cache:
+            self.cache.save()
+
+        self.saveSecurityCache()
+
+    def countProfile(self, op):
+        GlobalMetrics.profiles_emitted.inc(1, ("generated",))
+        GlobalMetrics.profile_rules.observe(len(op.rule_list))
+
+    def saveSecurityCache(self):
+        if self.security_cache == None:
+            return
+
+        sc = self.security_cache
+        GlobalLogger.info("Security checked %d rules, reused verdicts for %d", sc.checked, sc.reused)
+        sc.save()
+
+    #
+    # iterRenderedProfiles() with includes set, every profile is generated, then the
+    # shared rules are factored out and the include files are yielded after the
+    # profiles
+    def iterFactoredProfiles(self, names, generated):
         opl = []
-        opli = self.generateOutputProfiles()
-        cur_dict = {}
-
-        # Leave includes dsiabled for now
-        #oi = OutputInclude("All", None)
-        #oi.parseForIncludes(opli)
-
-        for op in opli:
-            # Profile timestamps can be re-added here, if need be
-            cur_profile = "" #op.getProfileStamp()
-            header = op.getProfileHeader()
-            if header == "":
-                # Error
-                print("Empty profile name/header fields.")
-                sys.exit(0)
-            cur_profile += header
-
-            cur_list = op.getRuleList()
-            # TODO: Test with various outputs to ensure we get the sorting we want. But this works for really basic tests.
-            cur_list.sort(reverse=True, key=lambda p: (-p.count(os.path.sep), p))
-
-            for cur_rule in cur_list:
-                # This is removed because it does partial matches, revisit
-                # if we find ourselves having dupe problems
-                #if cur_rule in cur_profile:
-                #    continue
-                if cur_rule == "":
-                    continue
-                # Subprofiles are handled differently, so no spacing or
-                # comma
-                if cur_rule.split()[0] == "profile":
-                    cur_profile += cur_rule
-                else:
-                    cur_profile += "    " + cur_rule + ",\n"
-
-            cur_profile += "}\n"
-
-            if op.filename == "":
-                print("**** MANUAL EDIT REQUIRED ****")
-                print("WARNING: Empty filename, appending to lostandfound")
-                print("********")
-                cur_dict["filename"] = "lostandfound"
+        for name in names:
+            op = next(generated)
+            if not self.reportViolations(name, op.exe_name, op.violations):
+                opl.append(op)
+
+        self.reportMinimized(sum(op.minimized for op in opl))
+
+        with self.profiler.stage("Includes") as st:
+            self.includes.parseForIncludes(opl)
+            st.items += len(opl)
+
+        for op in opl:
+            self.countProfile(op)
+            yield op.name, self.getOutputFilename(op), op, None
+
+        for filename in self.includes.includes:
+            buf = io.StringIO()
+            self.includes.renderInclude(filename, buf)
+            yield None, filename, None, buf.getvalue()
+
+    #
+    # Adds a profile's security violations to security_report when check_all is set,
+    # returns True if the profile has violations and must be left out of the output
+    def reportViolations(self, name, exe_path, violations):
+        if self.security_report == None:
+            return False
+
+        self.security_report.addProfile(name, exe_path, violations)
+        if violations:
+            GlobalLogger.warning("Profile %s left out of the output due to security violations", name)
+            return True
+
+        return False
+
+    def getOutputFilename(self, op):
+        if op.filename == "":
+            GlobalLogger.addManualEdit(op.name, "Empty filename, appending to lostandfound")
+            return "lostandfound"
+
+        return op.filename
+
+    #
+    # Writes the profile text for op to the stream fp, rule by rule
+    def renderProfile(self, op, fp):
+        # Profile timestamps can be re-added here, if need be
+        #fp.write(op.getProfileStamp())
+        header = op.getProfileHeader()
+        if header == "":
+            # Error
+            GlobalLogger.fatal("Empty profile name/header fields.")
+        fp.write(header)
+
+        for include in op.include_list:
+            fp.write("    " + include + "\n")
+
+        cur_list = op.getRuleList()
+        # TODO: Test with various outputs to ensure we get the sorting we want. But this works for really basic tests.
+        cur_list.sort(reverse=True, key=ruleSortKey)
+
+        for cur_rule in cur_list:
+            # This is removed because it does partial matches, revisit
+            # if we find ourselves having dupe problems
+            #if cur_rule in cur_profile:
+            #    continue
+            if cur_rule == "":
+                continue
+            # Subprofiles are handled differently, so no spacing or
+            # comma
+            if cur_rule.split()[0] == "profile":
+                fp.write(cur_rule)
+            elif cur_rule.startswith("#include"):
+                fp.write("    " + cur_rule + "\n")
             else:
-                cur_dict["filename"] = op.filename
+                fp.write("    " + cur_rule + ",\n")
+
+        fp.write("}\n")
 
-            cur_dict["profile"] = cur_profile
+    #
+    # Removes redundant rules from an OutputProfile, the number removed is kept in
+    # op.minimized
+    def minimizeOutputProfile(self, op):
+        with self.profiler.stage("Minimize") as st:
+            op.minimized = minimizeProfile(op)
+            st.items += 1
 
-            opl.append(cur_dict)
-            cur_dict = {}
+        if op.minimized:
+            GlobalLogger.info("For profile %s minimization eliminated %d redundant rules", op.name, op.minimized)
 
-        return opl
+    def reportMinimized(self, total):
+        if total:
+            GlobalLogger.info("Minimization eliminated %d rules in total", total)
 
     def isInLogList(self, entry, loglist):
         return False
@@ -261,184 +738,190 @@ class GenProfiles:
 
         return set(profile_list)
 
-    # It would be better practice to delegate this to the classes somehow, or at least part of it
-    # XXX
+    #
+    # Log entries and profile file rules are both kept in a RuleStore, keyed by their
+    # canonical identity, so merging an entry is a hash lookup instead of a scan over
+    # the profile. The merge for each type is picked from dedup_handlers.
+    #
     # Returns the new de-duplicated LOG list, profile duplicates will still exist
     def deDuplicate_Log(self, rule_list, profile_list):
-        file_dict = {}
-        new_list = []
+        log_store = RuleStore()
+        profile_store = RuleStore()
 
+        # Only file rules and capabilities are merged with log entries, others are
+        # deduped earlier
+        for s in profile_list:
+            if isinstance(s, (FileRule, CapableRule)):
+                profile_store.add(s)
+
+            if isinstance(s, FileRule) and isGlob(s.filename):
+                profile_store.addGlob(s.filename, s.perms)
+
+        handled = 0
         for entry in rule_list:
-            # We really only care about files
-            #
-            # We keep a dictionary of each file found. If a duplicate is found, we update the
-            # permissions.
-            if isinstance(entry, OpFile):
-                new_mask = entry.requested_mask.strip("\"")
-
-                # First, we check to see if we have a profile entry for this file
-                for s in profile_list:
-                    if not isinstance(s, FileRule):
-                        continue # We just care about the file rules here, others are deduped earlier
-
-                    if s.filename == entry.name:
-                        # Yes, so we use the profile entry to track the permissions and ignore future entries
-                        if new_mask in s.permissions:
-                            break
-                        new_mask += s.permissions
-                        profile_list.remove(s)
-
-                        break
-
-                if entry.name in file_dict:
-                    # Handle collision by updating requested_mask, then removing the entry from the list
-                    if new_mask in file_dict[entry.name].requested_mask:
-                        continue
-                    file_dict[entry.name].requested_mask += new_mask
-                else:
-                    # New file
-                    for c in new_mask:
-                        if not c in entry.requested_mask:
-                            entry.requested_mask += c
-                    file_dict[entry.name] = entry
-            elif isinstance(entry, OpCapable):
-                # TODO: make this more gooder?
-                file_dict[entry.capname] = entry
-            elif isinstance(entry, OpNetwork):
-                if not entry.family + entry.sock_type in file_dict:
-                    file_dict[entry.family.strip("\"") + entry.sock_type.strip("\"")] = entry
-            elif isinstance(entry, OpComment):
-                file_dict[entry.getDefaultRule().strip("\"")] = entry
-            elif isinstance(entry, OpSignal):
-                if not "signal" in file_dict:
-                    file_dict["signal"] = entry
-            elif isinstance(entry, OpPtrace):
-                if not "ptrace" in file_dict:
-                    file_dict["ptrace"] = entry
-
-        for entry in file_dict:
-            new_list.append(file_dict[entry])
-
-        return new_list, profile_list
+            handler = self.dedup_handlers.get(type(entry))
+            if handler == None:
+                continue
+
+            handler(entry, log_store, profile_store, profile_list)
+            handled += 1
+
+        GlobalMetrics.dedup_hits.inc(handled - len(log_store), ("merge",))
+        return list(log_store.values()), profile_list
+
+    # We keep a record of each file found. If a duplicate is found, we update the
+    # permissions.
+    def deDuplicate_File(self, entry, log_store, profile_store, profile_list):
+        key = entry.getRuleKey()
+        new_perms = entry.getPermissions()
+
+        # First, we check to see if we have a profile entry for this file
+        s = profile_store.get(FileRule, key)
+        if s != None:
+            # Yes, so we use the profile entry to track the permissions and ignore future entries
+            if not s.perms.covers(new_perms):
+                new_perms.update(s.perms)
+                profile_list.remove(s)
+                profile_store.remove(s, key)
+        elif profile_store.covers(key, new_perms):
+            # Already granted by a glob rule in the profile (e.g. /tmp/** rw), so
+            # this doesn't need a rule of its own
+            return
+
+        cur = log_store.get(OpFile, key)
+        if cur is not None:
+            # Handle collision by merging the permissions, then dropping the entry
+            cur.getPermissions().update(new_perms)
+        else:
+            # New file
+            log_store.add(entry, key)
+
+    # Capabilities the profile already grants are dropped, so we don't emit the
+    # same capability rule twice
+    def deDuplicate_Capability(self, entry, log_store, profile_store, profile_list):
+        key = entry.getRuleKey()
+
+        if profile_store.has(CapableRule, key):
+            return
+
+        if not log_store.has(OpCapable, key):
+            log_store.add(entry, key)
+
+    # Everything else is only kept once per identity
+    def deDuplicate_Keyed(self, entry, log_store, profile_store, profile_list):
+        key = entry.getRuleKey()
+
+        if not log_store.has(type(entry), key):
+            log_store.add(entry, key)
 
     # Finally, just do a basic text search. If it exists, we remove it.
     def deDuplicate_Text(self, profile_text):
         return None
 
-    def diffProfiles(self, old_list):
-        old_rl = old_list.rl
-        new_rl = self.rl
+    #
+    # Records the (header, rules) of each named profile as parsed from profile_dir.
+    # Generating a profile can change the parsed rule objects in place (library
+    # versions, merged subprofile permissions), so diffing needs them captured first.
+    def captureSourceRules(self, names):
+        for name in names:
+            if name not in self.source_rules:
+                self.source_rules[name] = self.getSourceRules(name)
+
+    # Returns None for profiles that only exist in the logs
+    def getSourceRules(self, name):
+        obj_list = self.rl.getProfileObjList(name)
+        if obj_list == None:
+            return None
+
+        header = ""
+        rules = []
+        for obj in obj_list:
+            if isinstance(obj, ProfileHeaderRule):
+                header = normalizeRule(obj.getProfileHeader())
+                continue
+
+            rule = obj.getProfileRule()
+            if rule:
+                rule = normalizeRule(rule)
+                if rule != "":
+                    rules.append(rule)
+
+        return header, rules
+
+    # (header, rules) of a generated profile
+    def getGeneratedRules(self, op):
+        header = normalizeRule(op.getProfileHeader(log_default=False))
+
+        rules = []
+        for rule in op.include_list + op.getRuleList():
+            rule = normalizeRule(rule)
+            if rule != "":
+                rules.append(rule)
+
+        return header, rules
 
-        old_names = old_rl.getProfileNames()
-        new_names = new_rl.getProfileNames()
+    #
+    # Diffs a generated profile entry from iterPolicyFiles() against the rules parsed
+    # from the existing profile, see Diff.diffProfileRules(). Profiles reused from the
+    # cache only have their text, that's split back into rules. Returns None for
+    # entries that aren't profiles (include files).
+    def diffPolicyFile(self, entry):
+        name = entry["name"]
+        if name == None:
+            return None
+
+        if name not in self.source_rules:
+            self.captureSourceRules([name])
+        old = self.source_rules[name]
+
+        if entry.get("op") != None:
+            new = self.getGeneratedRules(entry["op"])
+        else:
+            new = splitProfileText(entry["profile"])
 
-        new_profile_names = []
-        existing_profile_names = []
-        profile_changes = {}
-        new_profile_entries = {}
-        removed_profile_entries = {}
+        return diffProfileRules(name, old, new, self.fixLibraryPath)
 
-        # Construct a list of profiles that are brand new, if any
-        for cur_name in new_names:
-            if not cur_name in old_names:
-               new_profile_names.append(cur_name)
-            else:
-               existing_profile_names.append(cur_name)
-
-        # For new profiles, just output the whole thing as new
-        print("******** Profile Diff Results *********")
-        print("\nWarning: Diff functionality is beta and may not be reliable, please")
-        print(" confirm results with 'diff -u -p' and report inconsistencies.")
-        print("\nResults: ")
-        for name in new_profile_names:
-            # XXX I'd like to print these out eventually but for now that is tricky
-            print("New profile : " + name)
-
-        #
-        # Now the meat of the diff, we have to compare each object from the old list
-        # to the one in the new list. This may create problems with the way we dedup but
-        # prevens us from having to generate profiles, re-parse, then diff.
-        for cur_name in existing_profile_names:
-            # cur_obj is going to be a list of ProfileType objects (signal, file, etc)
-            cur_obj = new_rl.getProfileObjList(cur_name)
-            old_objlist = old_rl.getProfileObjList(cur_name)
-
-            for cur_newentry in cur_obj:
-                # Now we delegate the process of finding the entry in the list back to the type
-                # for every list entry
-                # 0 - No entry
-                # 1 - Identical entry found
-                # 2 - Entry found but changed
-                dr = cur_newentry.diff(old_objlist)
-                result = dr.result
-
-                # Entry in the new profile, but not the old
-                if result == 0:
-                    # There is a weird case here where files can be mutated during
-                    # getDefaultRule(), so the filename == filename condition is met
-                    # but the end result is actually different, so we have to make
-                    # a weird exception here
-
-                    new_fname = cur_newentry.getDefaultRule().split(" ")[0].replace('*', '')
-
-                    for entry in old_objlist:
-                        if isinstance(entry, FileRule):
-                            if entry.filename.replace('*', '') == new_fname:
-                                # Now we have an entry that hits the rough match criteria, so its' not unique
-                                result = 2
-                                dr.uuid = new_fname
-                                dr.result = 2
-                                dr.old_obj = entry
-
-                    if result == 0:
-                        if not cur_name in new_profile_entries:
-                            new_profile_entries[cur_name] = []
-
-                        new_profile_entries[cur_name].append(cur_newentry)
-
-                # Identical entry
-                if result == 1:
-                    for entry in old_objlist:
-                        if entry.filename == cur_newentry.filename:
-                            old_objlist.remove(entry)
-
-                # Exists in both but with differences
-                if result == 2:
-                    if not cur_name in profile_changes:
-                        profile_changes[cur_name] = []
-                    profile_changes[cur_name].append([cur_newentry, dr])
-
-                    # At this point, this really only applies to files. If that
-                    # changes then we should add a uuid to each profile type
-                    # also and compare those XXX
-                    for entry in old_objlist:
-                        if dr.uuid != None:
-                            if isinstance(entry, FileRule):
-                                if dr.uuid.replace('*', '') == entry.filename.replace('*', ''):
-                                    old_objlist.remove(entry)
-
-
-            # This is technically leftover entries, but it should be empty
-            for entry in old_objlist:
-                if not cur_name in removed_profile_entries:
-                    removed_profile_entries[cur_name] = []
-                removed_profile_entries[cur_name].append(entry)
-
-            print("Diff for profile: " + cur_name)
-            print("Profile changes: ")
-            if cur_name in profile_changes:
-                for n in profile_changes[cur_name]:
-                    print(n[1].old_obj.getDefaultRule() + " -> " + n[0].getDefaultRule())
-
-            print("New profile entries: ")
-            if cur_name in new_profile_entries:
-                for n in new_profile_entries[cur_name]:
-                    print(n.getDefaultRule())
-
-            print("Removed entries: ")
-            if cur_name in removed_profile_entries:
-                for d in removed_profile_entries[cur_name]:
-                    print(d.getDefaultRule())
-
-        return
+    # Library paths in the old profile get versions fixed in the new one, match them up
+    def fixLibraryPath(self, path):
+        if ".so" not in path:
+            return path
+        return FileRule().fixLibraryVersions(path)
 
+    #
+    # Generates every profile and diffs it against the existing profile, returns
+    # a Diff.DiffReport
+    def diffProfiles(self, jobs=1):
+        self.diff = True
+        report = DiffReport()
+
+        for entry in self.iterPolicyFiles(jobs):
+            pd = self.diffPolicyFile(entry)
+            if pd != None:
+                report.add(pd)
+
+        return report
+
+#
+# Process pool workers for generateOutputProfiles(), each worker keeps its own
+# GenProfiles with the same settings as the parent
+_worker_gen = None
+
+def _initWorker(generalize, minimize, check_all, profile=False, log_level=INFO, log_buffered=True):
+    global _worker_gen
+    # Forked workers start with a copy of the parent's metrics and log messages, which
+    # it already has
+    GlobalMetrics.reset()
+    GlobalLogger.reset()
+    GlobalLogger.configure(log_level, log_buffered)
+    profiler = None
+    if profile:
+        profiler = RunProfiler()
+    _worker_gen = GenProfiles(generalize=generalize, minimize=minimize, check_all=check_all, profiler=profiler)
+
+def _buildWorker(op):
+    op = _worker_gen.buildOutputProfile(op)
+    if isinstance(_worker_gen.profiler, RunProfiler):
+        op.stage_stats = _worker_gen.profiler.takeStats()
+    op.metrics = GlobalMetrics.takeSnapshot()
+    op.log_records = GlobalLogger.takeRecords()
+    return op
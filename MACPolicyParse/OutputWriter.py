@@ -0,0 +1,231 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import concurrent.futures
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+_umask = None
+_umask_lock = threading.Lock()
+
+#
+# Returns the process umask, read once on first use. Files from mkstemp() are always
+# 0600, writers use this to give them the mode open() would have used.
+#
+# os.umask() can only be read by setting it, which briefly leaves it at 0 for every
+# thread, so /proc is tried first and the lock keeps threads from racing on it
+def getUmask():
+    global _umask
+
+    with _umask_lock:
+        if _umask == None:
+            try:
+                with open("/proc/self/status") as fp:
+                    for line in fp:
+                        if line.startswith("Umask:"):
+                            _umask = int(line.split()[1], 8)
+                            break
+            except OSError:
+                pass
+
+            if _umask == None:
+                _umask = os.umask(0o022)
+                os.umask(_umask)
+
+        return _umask
+
+#
+# Change-aware profile writer
+#
+# Every file is compared against what is already on disk first, files whose content
+# hash didn't change are left alone (so their mtime doesn't change and nothing
+# downstream reloads them). Changed files are written to a temporary file in the same
+# directory and renamed into place, so readers never see a partial profile.
+#
+# @fsync - When to fsync:
+#   always - Each file before its rename, and the directory after it
+#   batch  - Files are renamed in batches of batch_size, fsyncing the whole batch
+#            before the renames and the directory once after
+#   never  - Leave it to the OS
+# @threads - Compare and write files on a thread pool of this size (0 or 1 for none)
+class OutputWriter:
+    fsync_policies = ["always", "batch", "never"]
+
+    def __init__(self, path, fsync="batch", batch_size=64, threads=0):
+        if fsync not in self.fsync_policies:
+            raise ValueError("Unknown fsync policy: " + str(fsync))
+
+        self.path = path
+        self.fsync = fsync
+        self.batch_size = batch_size
+
+        self.executor = None
+        if threads and threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+        self.pending = []
+        self.written = []
+        self.unchanged = []
+
+    def write(self, filename, content):
+        self.submit(filename, content.encode())
+
+    #
+    # Like write(), but render(fp) writes the content to fp, which hashes it as it goes.
+    # Rendering happens on the calling thread, comparing and writing the result is
+    # done on the thread pool like for write().
+    def writeStream(self, filename, render):
+        fp = _HashingWriter(io.BytesIO())
+        render(fp)
+        self.submit(filename, fp.raw.getvalue(), fp.hash)
+
+    def submit(self, filename, data, data_hash=None):
+        if self.executor:
+            self.pending.append(self.executor.submit(self.stageFile, filename, data, data_hash))
+        else:
+            self.pending.append(self.stageFile(filename, data, data_hash))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    #
+    # Writes data to a temporary file next to its destination, returns
+    # (filename, tmp_path, final_path), with tmp_path set to None when the file on
+    # disk already has the same content. Unchanged files are found before anything
+    # is created.
+    def stageFile(self, filename, data, data_hash=None):
+        final_path = os.path.join(self.path, filename)
+
+        if data_hash == None:
+            data_hash = hashlib.sha256(data)
+        if self.isUnchanged(final_path, len(data), data_hash):
+            return filename, None, final_path
+
+        final_dir = os.path.dirname(final_path)
+        os.makedirs(final_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=final_dir, prefix="." + os.path.basename(filename))
+        try:
+            # mkstemp() creates the file 0600, use the same mode open() would
+            os.fchmod(fd, 0o666 & ~getUmask())
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+                if self.fsync == "always":
+                    fp.flush()
+                    os.fsync(fp.fileno())
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return filename, tmp_path, final_path
+
+    def isUnchanged(self, final_path, size, new_hash):
+        try:
+            if os.path.getsize(final_path) != size:
+                return False
+
+            with open(final_path, "rb") as fp:
+                old_hash = hashlib.sha256(fp.read()).digest()
+        except OSError:
+            return False
+
+        return old_hash == new_hash.digest()
+
+    # Renames everything staged so far into place
+    def flush(self):
+        staged = []
+        for entry in self.pending:
+            if isinstance(entry, concurrent.futures.Future):
+                entry = entry.result()
+            staged.append(entry)
+        self.pending = []
+
+        to_rename = []
+        for filename, tmp_path, final_path in staged:
+            if tmp_path == None:
+                self.unchanged.append(filename)
+            else:
+                to_rename.append((filename, tmp_path, final_path))
+
+        if not to_rename:
+            return
+
+        if self.fsync == "batch":
+            tmp_paths = [x[1] for x in to_rename]
+            if self.executor:
+                list(self.executor.map(_fsyncPath, tmp_paths))
+            else:
+                for tmp_path in tmp_paths:
+                    _fsyncPath(tmp_path)
+
+        dirs = set()
+        for filename, tmp_path, final_path in to_rename:
+            os.replace(tmp_path, final_path)
+            self.written.append(filename)
+            dirs.add(os.path.dirname(final_path))
+
+        if self.fsync != "never":
+            for cur_dir in dirs:
+                _fsyncPath(cur_dir)
+
+    # Drops everything staged but not yet renamed into place
+    def abort(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+        for entry in self.pending:
+            if isinstance(entry, concurrent.futures.Future):
+                if entry.cancelled() or entry.exception():
+                    continue
+                entry = entry.result()
+            if entry[1] != None:
+                os.unlink(entry[1])
+        self.pending = []
+
+    # Flushes anything left, returns (written, unchanged) filename lists
+    def close(self):
+        self.flush()
+
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        return self.written, self.unchanged
+
+def _fsyncPath(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+#
+# Text stream that encodes and hashes everything written to it on the way to the
+# underlying binary stream, for OutputWriter.writeStream()
+class _HashingWriter:
+    def __init__(self, raw):
+        self.raw = raw
+        self.hash = hashlib.sha256()
+
+    def write(self, text):
+        data = text.encode()
+        self.raw.write(data)
+        self.hash.update(data)
+        return len(text)
@@ -0,0 +1,174 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from .Permissions import *
+from .Glob import *
+from .ProfileTypes import *
+from .LogTypes import *
+
+#
+# Wildcard generalization of file rules
+#
+# Long running logs produce a lot of near-identical paths (/tmp/session-8f3a/x,
+# /var/run/pid.12345, ...). The file rules for a profile are put into a trie of
+# their path components, then collapsed bottom up:
+#
+#   - Files in the same directory with the same permissions are replaced by
+#     "<dir>/* <perms>" once there are more than 'threshold' of them
+#   - Once more than 'threshold' subdirectories of a directory have rules with the
+#     same permissions, those rules are replaced by "<dir>/** <perms>"
+#
+# Rules are only ever folded into a wildcard with exactly their permissions, so
+# no path is granted a permission it didn't have. Rules with exec permissions are
+# never folded into a wildcard, and paths that are already globs are left alone.
+# The root directory is never collapsed, and "**" is never used directly under it
+# (recursive_min_depth), so there's no /etc/** or /usr/**.
+#
+# Each rule is handled once per directory level, so this is linear in the number
+# of distinct paths times the path depth.
+
+class PathTrieNode:
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+
+class PathTrie:
+    def __init__(self, threshold, min_depth=1, recursive_min_depth=2):
+        self.root = PathTrieNode()
+        self.threshold = threshold
+        self.min_depth = min_depth
+        self.recursive_min_depth = max(min_depth, recursive_min_depth)
+        self.collapsed = 0
+
+    def insert(self, path, perms, obj):
+        node = self.root
+        for comp in path.split("/"):
+            if comp == "":
+                continue
+            if comp not in node.children:
+                node.children[comp] = PathTrieNode()
+            node = node.children[comp]
+
+        node.rules.append((path, perms, obj))
+
+    #
+    # Returns the list of (path, perms, obj) left after collapsing, where obj is
+    # None for generated wildcard rules
+    def generalize(self):
+        return self._collapse(self.root, "", 0)
+
+    def _collapse(self, node, path, depth):
+        out = list(node.rules)
+
+        leaf_groups = {}
+        dir_rules = []
+        dir_count = 0
+
+        for comp, child in node.children.items():
+            child_rules = self._collapse(child, path + "/" + comp, depth + 1)
+
+            if not child.children:
+                # Plain files directly in this directory
+                for rule in child_rules:
+                    if rule[1].hasExec() or isGlob(rule[0]):
+                        out.append(rule)
+                        continue
+                    key = rule[1].render()
+                    if key not in leaf_groups:
+                        leaf_groups[key] = []
+                    leaf_groups[key].append(rule)
+            else:
+                dir_count += 1
+                dir_rules.append(child_rules)
+
+        if depth < self.min_depth:
+            for group in leaf_groups.values():
+                out.extend(group)
+            for rules in dir_rules:
+                out.extend(rules)
+            return out
+
+        for key, group in leaf_groups.items():
+            if len(group) > self.threshold:
+                self.collapsed += len(group)
+                out.append((path + "/*", group[0][1].copy(), None))
+            else:
+                out.extend(group)
+
+        if dir_count <= self.threshold or depth < self.recursive_min_depth:
+            for rules in dir_rules:
+                out.extend(rules)
+            return out
+
+        # Same as the leaf groups, but counting the subdirectories each set of
+        # permissions shows up in
+        dir_groups = {}
+        dir_counts = {}
+        for idx, rules in enumerate(dir_rules):
+            seen = set()
+            for rule in rules:
+                if rule[1].hasExec() or (rule[2] is not None and isGlob(rule[0])):
+                    out.append(rule)
+                    continue
+                key = rule[1].render()
+                if key not in dir_groups:
+                    dir_groups[key] = []
+                    dir_counts[key] = 0
+                dir_groups[key].append(rule)
+                if key not in seen:
+                    seen.add(key)
+                    dir_counts[key] += 1
+
+        for key, group in dir_groups.items():
+            if dir_counts[key] > self.threshold:
+                self.collapsed += len(group)
+                out.append((path + "/**", group[0][1].copy(), None))
+            else:
+                out.extend(group)
+
+        return out
+
+#
+# Generalizes the OpFile entries in rule_list, returns the new list with the
+# collapsed entries replaced by FileRule wildcards, along with the number of
+# entries that were collapsed. Everything that isn't an OpFile passes through.
+def generalizePaths(rule_list, threshold, min_depth=1, recursive_min_depth=2):
+    trie = PathTrie(threshold, min_depth, recursive_min_depth)
+    new_list = []
+
+    for entry in rule_list:
+        if not isinstance(entry, OpFile):
+            new_list.append(entry)
+            continue
+
+        rule = entry.getDefaultRule()
+        if rule == "":
+            new_list.append(entry)
+            continue
+
+        trie.insert(rule.rsplit(" ", 1)[0], entry.getPermissions(), entry)
+
+    for path, perms, obj in trie.generalize():
+        if obj is not None:
+            new_list.append(obj)
+            continue
+
+        fr = FileRule()
+        fr.filename = path
+        fr.perms = perms
+        new_list.append(fr)
+
+    return new_list, trie.collapsed
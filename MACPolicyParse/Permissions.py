@@ -0,0 +1,170 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# AppArmor file permissions as an integer bitmask, shared by log entries (OpFile)
+# and profile rules (FileRule) so merging, comparing, and checking permissions
+# are integer operations instead of string manipulation.
+#
+# Log masks and profile permission strings don't use the same letters ('c' is
+# create in a log mask but a child transition in a profile), so each has its own
+# constructor: fromLogMask() and fromProfile().
+#
+# Characters we don't know about are kept as-is in 'extra' and rendered at the end,
+# so unsupported permissions are never silently dropped.
+
+PERM_READ       = 1 << 0   # r
+PERM_WRITE      = 1 << 1   # w
+PERM_APPEND     = 1 << 2   # a
+PERM_LINK       = 1 << 3   # l
+PERM_LOCK       = 1 << 4   # k
+PERM_MMAP       = 1 << 5   # m
+PERM_EXEC       = 1 << 6   # x
+PERM_INHERIT    = 1 << 7   # i (ix, pix, cix)
+PERM_PROFILE    = 1 << 8   # p
+PERM_PROFILE_S  = 1 << 9   # P (scrubbed environment)
+PERM_CHILD      = 1 << 10  # c
+PERM_CHILD_S    = 1 << 11  # C
+PERM_UNCONF     = 1 << 12  # u
+PERM_UNCONF_S   = 1 << 13  # U
+
+# Everything that makes up an exec permission (x and its transition qualifiers)
+PERM_EXEC_MODE  = PERM_EXEC | PERM_INHERIT | PERM_PROFILE | PERM_PROFILE_S | PERM_CHILD | \
+                  PERM_CHILD_S | PERM_UNCONF | PERM_UNCONF_S
+
+# Order used when rendering. Exec transitions go before their fallback (e.g. Pix)
+_access_chars = [("r", PERM_READ), ("w", PERM_WRITE), ("a", PERM_APPEND), ("l", PERM_LINK), ("k", PERM_LOCK)]
+_exec_chars = [("P", PERM_PROFILE_S), ("p", PERM_PROFILE), ("C", PERM_CHILD_S), ("c", PERM_CHILD),
+               ("U", PERM_UNCONF_S), ("u", PERM_UNCONF), ("i", PERM_INHERIT)]
+
+_profile_chars = dict(_access_chars + _exec_chars + [("m", PERM_MMAP), ("x", PERM_EXEC)])
+
+# Kernel log masks: create/delete map to write, exec is reported as plain 'x', which
+# we turn into ix
+_log_chars = {
+    "r": PERM_READ,
+    "w": PERM_WRITE,
+    "a": PERM_APPEND,
+    "c": PERM_WRITE,
+    "d": PERM_WRITE,
+    "l": PERM_LINK,
+    "k": PERM_LOCK,
+    "m": PERM_MMAP,
+    "x": PERM_EXEC | PERM_INHERIT,
+    "i": 0,
+    ":": 0,
+}
+
+class FilePermissions:
+    def __init__(self, mask=0, extra=""):
+        self.mask = mask
+        self.extra = extra
+        self._rendered = None
+
+    @staticmethod
+    def fromLogMask(mask_str):
+        return FilePermissions._parse(mask_str, _log_chars)
+
+    @staticmethod
+    def fromProfile(perm_str):
+        return FilePermissions._parse(perm_str, _profile_chars)
+
+    @staticmethod
+    def _parse(perm_str, char_table):
+        mask = 0
+        extra = ""
+
+        for c in perm_str.strip("\",\n"):
+            if c in char_table:
+                mask |= char_table[c]
+            elif c not in extra:
+                extra += c
+
+        return FilePermissions(mask, extra)
+
+    def copy(self):
+        return FilePermissions(self.mask, self.extra)
+
+    def union(self, other):
+        perms = self.copy()
+        perms.update(other)
+        return perms
+
+    # In place union
+    def update(self, other):
+        self.mask |= other.mask
+        for c in other.extra:
+            if c not in self.extra:
+                self.extra += c
+        self._rendered = None
+
+    # True if every permission in other is also granted here
+    def covers(self, other):
+        if other.mask & ~self.mask:
+            return False
+
+        for c in other.extra:
+            if c not in self.extra:
+                return False
+
+        return True
+
+    def isEmpty(self):
+        return self.mask == 0 and self.extra == ""
+
+    def hasExec(self):
+        return bool(self.mask & PERM_EXEC)
+
+    # The exec permission with its transition (ix, px, Cx, ...), 0 without exec
+    def execMode(self):
+        return self.mask & PERM_EXEC_MODE
+
+    def render(self):
+        if self._rendered != None:
+            return self._rendered
+
+        out = ""
+        for c, bit in _access_chars:
+            # Write implies append, and AppArmor rejects both on one rule
+            if bit == PERM_APPEND and self.mask & PERM_WRITE:
+                continue
+            if self.mask & bit:
+                out += c
+
+        for c, bit in _exec_chars:
+            if self.mask & bit:
+                out += c
+        if self.mask & PERM_EXEC:
+            out += "x"
+
+        if self.mask & PERM_MMAP:
+            out += "m"
+
+        self._rendered = out + self.extra
+        return self._rendered
+
+    def __eq__(self, other):
+        return isinstance(other, FilePermissions) and \
+                self.mask == other.mask and self.extra == other.extra
+
+    def __hash__(self):
+        return hash((self.mask, self.extra))
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return self.render()
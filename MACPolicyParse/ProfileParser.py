@@ -15,6 +15,7 @@
 #
 
 from .ProfileTypes import *
+from .Util import *
 import os
 
 class Profile:
@@ -26,13 +27,19 @@ class Profile:
     filename = ""   # Path for the profile itself, taken from file path
 
     Parses capability, file, and profile header rules.
+
+    Profiles can also be loaded lazily: loadHeader() only reads the
+    profile header line, and the body is parsed by load() the first
+    time the rules are needed.
     '''
 
     name = ""
     rule_objlist = []
 
-    def __init__(self, filename):
+    def __init__(self, filename, source=None):
         self.filename = filename
+        self.source = source
+        self.loaded = True
         self.rule_objlist = []
         self.exe_path = ""
         self.name = ""
@@ -42,6 +49,48 @@ class Profile:
 
         return
 
+    def loadHeader(self):
+        '''
+        Scans the source file for the first profile header and sets the
+        name and exe path from it, without parsing the rest of the file.
+        '''
+        self.loaded = False
+
+        with open(self.source, "r") as fp:
+            for line in fp:
+                rule = [a.strip("\n,}") for a in line.split()]
+                if not ProfileHeaderRule().isType(rule):
+                    continue
+
+                pr = ProfileHeaderRule()
+                pr.parse(rule)
+                self.name = pr.name
+                self.exe_path = pr.path
+                return
+
+    def load(self):
+        '''
+        Parses the whole profile from the source file, if it hasn't been
+        already.
+        '''
+        if self.loaded:
+            return
+
+        # The header is parsed again below, clear it so it isn't mistaken
+        # for a subprofile. rule_objlist is cleared in place since callers
+        # may already hold a reference to it.
+        self.name = ""
+        self.exe_path = ""
+        self._subprofile_ctx = None
+        del self.rule_objlist[:]
+        self._cur_objlist = self.rule_objlist
+
+        with open(self.source, "r") as fp:
+            for line in fp.readlines():
+                self.addRuleStr(line)
+
+        self.loaded = True
+
     def addRuleStr(self, rule):
         """
         Strips whitespace from the beginning of each profile line and
@@ -59,7 +108,7 @@ class Profile:
         rule, and adds it to the object's rule_objlist.
         '''
         if type(rule) is not list:
-            print("WARNING: Non-list passed to addRuleList")
+            GlobalLogger.warning("Non-list passed to addRuleList")
             return
         if rule[0] == '' or rule[0] == '}':
             # Ignore these for now, make a class for them later XXX
@@ -117,6 +166,8 @@ class Profile:
              # the profile header and ends when a } is enocuntered
             if self.name != "" or self.exe_path != "":
                 self._subprofile_ctx = TransitionProfileRule(self.name, self.exe_path)
+                self._subprofile_ctx.source_name = pr.name
+                self._subprofile_ctx.source_path = pr.path
                 #self._subprofile_ctx.parse(rule)
                 self._cur_objlist = self._subprofile_ctx.profile_ruleobjs
 
@@ -147,11 +198,9 @@ class Profile:
             ptr.parse(rule)
             self._cur_objlist.append(ptr)
         else:
-            print("WARNING: Unknown rule type for rule. Raw rule added.")
-            print("Raw rules are not validated, parsed, or updated. Please file")
-            print("An issue with the contents of the rule below so we can implement")
-            print("support for this rule type.")
-            print("Rule: " + str(rule))
+            GlobalLogger.warning("Unknown rule type for rule, raw rule added. Raw rules are not validated, parsed, "
+                                 "or updated. Please file an issue with the contents of the rule so we can implement "
+                                 "support for this rule type. Rule: %s", str(rule))
 
             ptr = RawRule()
             ptr.setRawRule(rule)
@@ -161,40 +210,69 @@ class Profile:
 
 #
 # Primary front end interface for parsing existing profiles
+#
+# Profiles are indexed three ways so lookups never have to scan the whole set:
+#   entries        - profile name -> Profile (insertion ordered, used for iteration)
+#   filename_index - profile file name -> Profile
+#   path_index     - exe path from the profile header -> Profile
+#
+# With lazy set, only the profile headers are read at load time and each body
+# is parsed the first time its rules are requested through getObjList()
 class ProfileParser:
-    def __init__(self):
-        self.names_list = []
+    def __init__(self, lazy=False):
         self.entries = {}
+        self.filename_index = {}
+        self.path_index = {}
+        self.lazy = lazy
 
     def loadProfile(self, path, filename):
-        print("Loading profile from file: " + path + filename)
+        GlobalLogger.debug("Loading profile from file: %s", path + filename)
 
         if os.path.isdir(path + "/" + filename):
-            print("ERROR: Path is directory, skipping")
-            print("Path: " + path + filename)
+            GlobalLogger.error("Path is directory, skipping: %s", path + filename)
             return
 
-        if filename in self.names_list:
-            print("****** MANUAL EDIT REQUIRED ******")
-            print("*: loadProfile found a duplicate profile name, skipping")
-            print("* Profile path 1: " + filename)
-            print("* Duplicate profile names will NOT be merged, manually merge them and delete the duplicate.")
-            print("************")
+        if filename in self.filename_index:
+            GlobalLogger.addManualEdit(filename, "loadProfile found a duplicate profile filename, skipping")
             return
 
-        cp = Profile(filename)
+        cp = Profile(filename, path + "/" + filename)
 
-        with open(path + "/" + filename, "r") as fp:
-            for line in fp.readlines():
-                cp.addRuleStr(line)
+        if self.lazy:
+            cp.loadHeader()
+        else:
+            with open(cp.source, "r") as fp:
+                for line in fp.readlines():
+                    cp.addRuleStr(line)
+
+        self.addEntry(cp)
+
+    def addEntry(self, cp):
+        if cp.name in self.entries:
+            GlobalLogger.addManualEdit(cp.name, "loadProfile found a duplicate profile name in %s and %s, skipping. "
+                                       "Duplicate profile names will NOT be merged, manually merge them and delete "
+                                       "the duplicate.", self.entries[cp.name].filename, cp.filename)
+            return
 
-            self.names_list.append(cp.name)
-            self.entries[cp.name] = cp
+        self.entries[cp.name] = cp
+        self.filename_index[cp.filename] = cp
+
+        # Several profiles can share an exe path (e.g. a placeholder header), the
+        # first one loaded wins, same as with names
+        if cp.exe_path and cp.exe_path not in self.path_index:
+            self.path_index[cp.exe_path] = cp
 
     def loadProfilesDir(self, path, skip):
+        if skip:
+            skip = set(skip)
+
         for x in os.listdir(path):
+            # Subdirectories hold abstractions/tunables/include files, not profiles
+            if os.path.isdir(os.path.join(path, x)):
+                continue
+
             if skip and x in skip:
-                print("Skipping profile due to skip_profile arg: " + x)
+                GlobalLogger.info("Skipping profile due to skip_profile arg: %s", x)
                 continue
 
             self.loadProfile(path, x)
@@ -204,16 +282,56 @@ class ProfileParser:
         return self.entries[key].name
 
     def getObj(self, key):
+        self.entries[key].load()
         return self.entries[key].rule_objlist
 
     def getObjList(self, name):
         if name in self.entries:
+            self.entries[name].load()
             return self.entries[name].rule_objlist
         else:
             return None
 
+    def isLoaded(self, name):
+        return name in self.entries and self.entries[name].loaded
+
+    # Profiles that were never parsed past their header
+    def getUnloaded(self):
+        return [cp for cp in self.entries.values() if not cp.loaded]
+
     def getNameList(self):
-        return self.names_list
+        return list(self.entries)
+
+    def hasName(self, name):
+        return name in self.entries
+
+    def getByName(self, name):
+        return self.entries.get(name)
+
+    def getByFilename(self, filename):
+        return self.filename_index.get(filename)
+
+    def getByPath(self, exe_path):
+        return self.path_index.get(exe_path)
+
+    #
+    # Maps a normalized log profile name back to the name of a loaded profile.
+    #
+    # Log lines for profiles attached by path carry the exe path rather than the
+    # profile name (normalized to "usr/bin/foo"), and some carry the profile file
+    # name instead, so check the name first, then the path and filename indexes.
+    # Unknown names are returned as-is.
+    def resolveName(self, name):
+        if name in self.entries:
+            return name
+
+        cp = self.path_index.get("/" + name)
+        if cp == None:
+            cp = self.filename_index.get(name)
+        if cp == None:
+            return name
+
+        return cp.name
 
     def getFilename(self, name):
         if name in self.entries:
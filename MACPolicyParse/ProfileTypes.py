@@ -17,6 +17,10 @@
 import re
 import os
 from .Diff import *
+from .Permissions import *
+from .Capabilities import *
+from .Metrics import *
+from .Util import *
 
 class ProfileBase:
     rule_type = ""
@@ -26,12 +30,12 @@ class ProfileBase:
         return
 
     def isType(self, rule):
-        print("WARNING: Pure virtual call to ProfileBase.isType")
+        GlobalLogger.warning("Pure virtual call to ProfileBase.isType")
         return False
 
     def validateList(self, rule, size):
         if type(rule) is not list:
-            print("WARNING: Non-list passed into validateList")
+            GlobalLogger.warning("Non-list passed into validateList")
             return False
 
         if size != None and len(rule) != size:
@@ -43,9 +47,14 @@ class ProfileBase:
         return True
 
     def getDefaultRule(self):
-        print("WARNING: Pure virtual to Profile.getDefaultRule")
+        GlobalLogger.warning("Pure virtual to Profile.getDefaultRule")
         return "# PURE VIRTUAL FAIL"
 
+    # The rule as it was written in the profile, for diffing against the generated
+    # one. Only differs from getDefaultRule() for rules that get rewritten on output.
+    def getProfileRule(self):
+        return self.getDefaultRule()
+
     def isDuplicate(self):
         return False
 
@@ -113,19 +122,34 @@ class ProfileHeaderRule(ProfileBase):
 # e.g. ['/foo/bar', 'rw']
 class FileRule(ProfileBase):
     filename = ""
-    permissions = ""
+    source_filename = "" # filename as parsed, before library versions are fixed
     handled = False
 
     def __init__(self):
         ProfileBase.__init__(self)
         self.priority = 20 #XXX Make a single class for these so wthey can be uniform for logs and profiles
+        self.perms = FilePermissions()
         return
 
+    # The permission string is always rendered from the bitmask
+    @property
+    def permissions(self):
+        return self.perms.render()
+
+    @permissions.setter
+    def permissions(self, perm_str):
+        self.perms = FilePermissions.fromProfile(perm_str)
+
     def getDefaultRule(self):
         # XXX Validate
 
         if ".so" in self.filename:
-            self.filename = self.fixLibraryVersions(self.filename)
+            filename = self.fixLibraryVersions(self.filename)
+            # Counted here rather than in fixLibraryVersions(), which the diff also
+            # uses to match up library paths without rewriting anything
+            if filename != self.filename:
+                GlobalMetrics.library_normalizations.inc(1, ("profile",))
+            self.filename = filename
 
             if self.filename == "" or self.filename == None:
                 # Empty spaces are cleaned up elsewhere
@@ -133,6 +157,12 @@ class FileRule(ProfileBase):
 
         return self.filename + " " + self.permissions
 
+    def getProfileRule(self):
+        return (self.source_filename or self.filename) + " " + self.permissions
+
+    def getRuleKey(self):
+        return self.filename
+
     def isType(self, rule):
         if not ProfileBase.validateList(ProfileBase(), rule, 2):
             return False
@@ -155,8 +185,9 @@ class FileRule(ProfileBase):
 
         # XXX Add more validation here
         self.filename = rule[0]
+        self.source_filename = rule[0]
 
-        self.permissions = rule[1].strip("\n,") # XXX End of the line has to have ,\n stripped
+        self.perms = FilePermissions.fromProfile(rule[1].strip("\n,")) # XXX End of the line has to have ,\n stripped
 
     # If we keep running into cases where profile changes need to be made in a sweeping manner,
     # we may want to add an API for doing this similar to the securitycheck rules
@@ -188,10 +219,7 @@ class FileRule(ProfileBase):
             lib_path = filename[:filename.rfind('/') + 1]
 
         else:
-            print("ERROR: Could not find / in lib path name")
-            print("-> Original filename: ")
-            print(filename)
-            sys.exit(0)
+            GlobalLogger.fatal("Could not find / in lib path name\n-> Original filename: %s", filename)
 
         new_rule = ""
         new_rule += lib_path
@@ -205,10 +233,7 @@ class FileRule(ProfileBase):
                 base_libname = m.groups()[0]
                 new_rule += base_libname + "-*"
             else:
-                print("ERROR: fixLibraryVersions() invalid regex version string match")
-                print("-> Original filename: ")
-                print(filename)
-                sys.exit(0)
+                GlobalLogger.fatal("fixLibraryVersions() invalid regex version string match\n-> Original filename: %s", filename)
         else:
             # No version string, just use the library name
             new_rule += lib_name[:lib_name.rfind('.so')]
@@ -233,13 +258,10 @@ class FileRule(ProfileBase):
         # This can happen if there is a bug here or a format we do not expect, it's not
         # very likely, but is possible and it's safer to exit
         if new_rule == "/lib*.so*":
-            print("ERROR: fixLibraryVersions() created an invalid entry due to a bug")
-            print("-> Original filename: ")
-            print(filename)
-            print("First, please verify there are no \"lib*.so*\" entries in the input profiles.")
-            print("If there are, please remove them and try again. If there are not, then ")
-            print("please submit the filename above as a bug report with this error.")
-            sys.exit(0)
+            GlobalLogger.fatal("fixLibraryVersions() created an invalid entry due to a bug\n-> Original filename: %s\n"
+                               "First, please verify there are no \"lib*.so*\" entries in the input profiles.\n"
+                               "If there are, please remove them and try again. If there are not, then\n"
+                               "please submit the filename above as a bug report with this error.", filename)
 
         return new_rule
 
@@ -250,7 +272,7 @@ class FileRule(ProfileBase):
             if isinstance(entry, FileRule):
                 if entry.filename == self.filename:
                     # Same filename means we have some sort of match
-                    if entry.permissions == self.permissions:
+                    if entry.perms == self.perms:
                         # Identical
                         return DiffResult(1, entry, self)
                     else:
@@ -262,6 +284,7 @@ class FileRule(ProfileBase):
 #   XXX Mainly warn on this
 class CapableRule(ProfileBase):
     capability = ""
+    cap_num = -1
 
     def __init__(self):
         ProfileBase.__init__(self)
@@ -272,6 +295,15 @@ class CapableRule(ProfileBase):
         # XXX validate
         return "capability " + self.capability
 
+    def getCapability(self):
+        return self.cap_num
+
+    # Same keys as OpCapable.getRuleKey()
+    def getRuleKey(self):
+        if self.cap_num != -1:
+            return self.cap_num
+        return self.capability
+
     def isType(self, rule):
         if not ProfileBase.validateList(ProfileBase(), rule, 2):
             return False
@@ -288,13 +320,16 @@ class CapableRule(ProfileBase):
         if not self.isType(rule):
             return None
 
-        # XXX Add validation that the capability is in the cap list
         self.capability = rule[1].strip("\n,")
+        self.cap_num = capNumber(self.capability)
+
+        if self.cap_num == -1:
+            GlobalLogger.warning("Unknown capability in profile: %s", self.capability)
 
     def diff(self, obj_list):
         for entry in obj_list:
             if isinstance(entry, CapableRule):
-                if entry.capability == self.capability:
+                if entry.getRuleKey() == self.getRuleKey():
                     return DiffResult(1, entry, self)
         return DiffResult(0, None, self, uuid=self.capability)
 
@@ -376,6 +411,10 @@ class TransitionProfileRule(ProfileBase):
 
             self.name = name
             self.exe_path = exe_path
+
+            # Name and path from the subprofile's own header, as parsed
+            self.source_name = name
+            self.source_path = exe_path
             return
 
         # Unique to this class
@@ -393,7 +432,7 @@ class TransitionProfileRule(ProfileBase):
         def parse(self, rule):
             # The header parsing is handled by the header type, so this
             # should never be reached (see generateOutputProfiles())
-            print("WARNING: TransitionProfileRule:parse() called.\n")
+            GlobalLogger.warning("TransitionProfileRule:parse() called.")
             return None
 
         #
@@ -413,6 +452,14 @@ class TransitionProfileRule(ProfileBase):
 
             return rule_str
 
+        def getProfileRule(self):
+            rule_str = "   profile " + self.source_name + " " + self.source_path + " {\n"
+            for r in self.profile_ruleobjs:
+                rule_str += "       " + r.getProfileRule() + ",\n"
+            rule_str += "   }\n"
+
+            return rule_str
+
 class IncludeRule(ProfileBase):
 
     def __init__(self):
@@ -465,11 +512,11 @@ class RawRule(ProfileBase):
         # This can be dangerous, we have to explicitly call this instead of using
         # isType() checks. We always return false here, but this should never
         # be called.
-        print("WARNING: RawRule.isType() should never be called.\n")
+        GlobalLogger.warning("RawRule.isType() should never be called.")
         return False
 
     def parse(self, rule):
-        print("WARNING: RawRule.parse() should never be called.\n")
+        GlobalLogger.warning("RawRule.parse() should never be called.")
         return None
 
     def setRawRule(self, rule_txt):
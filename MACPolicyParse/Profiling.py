@@ -0,0 +1,197 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+from .Metrics import *
+
+#
+# Timings for one pipeline stage, a stage can be entered many times (e.g. once per
+# profile) and the totals are kept
+class StageStats:
+    def __init__(self, name, depth=0):
+        self.name = name
+        self.depth = depth
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = 0
+        self.items = 0
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.peak = max(self.peak, other.peak)
+        self.items += other.items
+
+    def toDict(self):
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "peak_bytes": self.peak,
+            "items": self.items,
+            "items_per_sec": self.items / self.wall if self.wall else 0,
+        }
+
+#
+# Per-stage profiling for a run
+#
+#   with profiler.stage("Parse log") as st:
+#       st.items = rl.parseLogfile(path)
+#
+# Every stage gets wall and CPU time, with memory set the peak traced memory while
+# the stage ran, and with cprofile set a cProfile of each top level stage. Stages
+# can be nested, nested stages are shown indented under the one they ran in. The
+# wall time of each run of a stage also goes to GlobalMetrics.stage_duration.
+#
+# CPU time is for this process only. Stages that run in worker processes are timed
+# there and added with mergeStats().
+class RunProfiler:
+    def __init__(self, memory=False, cprofile=False):
+        self.memory = memory
+        self.cprofile = cprofile
+        self.stats = {}
+        self.stack = []
+        self.profiles = {}
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def enter(self, name):
+        st = self.stats.get(name)
+        if st == None:
+            st = StageStats(name, len(self.stack))
+            self.stats[name] = st
+
+        if self.memory:
+            # The peak is reset for each stage, so the enclosing stage is given the
+            # peak so far first
+            if self.stack:
+                parent = self.stack[-1]
+                parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        # Only one cProfile can be active at a time, so only top level stages get one
+        if self.cprofile and not self.stack:
+            prof = self.profiles.get(name)
+            if prof == None:
+                prof = cProfile.Profile()
+                self.profiles[name] = prof
+            prof.enable()
+
+        self.stack.append(st)
+        st.calls += 1
+        return st, time.perf_counter(), time.process_time()
+
+    def exit(self, st, wall_start, cpu_start):
+        wall = time.perf_counter() - wall_start
+        st.wall += wall
+        st.cpu += time.process_time() - cpu_start
+        GlobalMetrics.stage_duration.observe(wall, (st.name,))
+        self.stack.pop()
+
+        if self.cprofile and not self.stack:
+            self.profiles[st.name].disable()
+
+        if self.memory:
+            st.peak = max(st.peak, tracemalloc.get_traced_memory()[1])
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, st.peak)
+
+    #
+    # Returns the stats gathered so far and starts over, used to ship stats from
+    # worker processes to the parent
+    def takeStats(self):
+        stats = self.stats
+        self.stats = {}
+        return stats
+
+    def mergeStats(self, stats):
+        for name, other in stats.items():
+            st = self.stats.get(name)
+            if st == None:
+                # Worker stages ran under whichever stage the parent is in now
+                st = StageStats(name, len(self.stack) + other.depth)
+                self.stats[name] = st
+            st.merge(other)
+
+    def printTable(self):
+        print(f"{'Stage':34} {'Calls':>8} {'Wall':>10} {'CPU':>10} {'Peak':>10} {'Items':>10} {'Rate':>12}")
+        for st in self.stats.values():
+            name = "  " * st.depth + st.name
+            peak = f"{st.peak / 1048576:.2f}MB" if self.memory else "-"
+            rate = st.items / st.wall if st.wall else 0
+            print(f"{name:34} {st.calls:>8} {st.wall:>9.3f}s {st.cpu:>9.3f}s {peak:>10} {st.items:>10} {rate:>10.0f}/s")
+
+    #
+    # Writes <stage>.prof cProfile dumps for each top level stage (for pstats or
+    # snakeviz), stages.json with the table, and with memory set memory.snapshot,
+    # a tracemalloc snapshot from the end of the run
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        for name, prof in self.profiles.items():
+            prof.dump_stats(os.path.join(path, name.replace(" ", "_").replace("/", "_") + ".prof"))
+
+        with open(os.path.join(path, "stages.json"), "w") as fp:
+            json.dump([st.toDict() for st in self.stats.values()], fp, indent=1)
+
+        if self.memory:
+            tracemalloc.take_snapshot().dump(os.path.join(path, "memory.snapshot"))
+
+class _StageTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.state = self.profiler.enter(self.name)
+        return self.state[0]
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.exit(*self.state)
+        return False
+
+#
+# Stand in when profiling is off, so the pipeline can always call stage()
+class NullProfiler:
+    def stage(self, name):
+        return _null_stage
+
+    def mergeStats(self, stats):
+        pass
+
+class _NullStage:
+    def __init__(self):
+        self.items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_null_stage = _NullStage()
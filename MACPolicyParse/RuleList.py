@@ -20,6 +20,7 @@ from .ProfileTypes import *
 import re
 from .LogTypes import *
 from .ProfileParser import *
+from .Util import *
 #
 # This is the container class for all of the other rule types: those from files and those from log entries
 #
@@ -33,33 +34,50 @@ from .ProfileParser import *
 class RuleList:
     file_rule_dict = {}
 
-    def __init__(self, f=None):
-        self.log_parser = LogParser()
+    def __init__(self, f=None, lazy=False):
         self.file_rule_dict = {}
 
-        self.pp = ProfileParser()
+        self.pp = ProfileParser(lazy)
+        self.log_parser = LogParser(self.pp.resolveName)
 
         if f:
             self.parseLogfile(f)
 
     #
-    # Primary front end for inserting data related to existing profiles
+    # Primary front end for inserting data related to existing profiles, returns the
+    # number of profiles loaded
     def loadExistingProfiles(self, profile_path, skip):
         # Load existing profiles
         self.pp.loadProfilesDir(profile_path, skip)
 
-        for key in self.pp.names_list:
-            print("Initializing for profile: " + self.pp.entries[key].name)
-            self.addFileList(self.pp.entries[key], self.pp.entries[key].rule_objlist)
+        for cp in self.pp.entries.values():
+            GlobalLogger.debug("Initializing for profile: %s", cp.name)
+            self.addFileList(cp, cp.rule_objlist)
+
+        return len(self.pp.entries)
 
     #
-    # Primary frontend for log parsing
+    # Primary frontend for log parsing, returns the number of lines read
     def parseLogfile(self, f):
-        self.log_parser.parseLogfile(f)
+        return self.log_parser.parseLogfile(f)
 
     def getLogNames(self):
         return self.log_parser.getNameList()
 
+    def hasLogName(self, name):
+        return self.log_parser.hasName(name)
+
+    # Unlike hasLogName(), which also covers names registered by loaded profiles,
+    # this is only true when the logs have entries for the profile
+    def hasLogEntries(self, name):
+        return name in self.log_parser.entries
+
+    def hasProfileName(self, name):
+        return self.pp.hasName(name)
+
+    def resolveName(self, name):
+        return self.pp.resolveName(name)
+
     def getLogObjList(self, name):
         return self.log_parser.getObjList(name)
 
@@ -75,6 +93,9 @@ class RuleList:
     def getProfileObjList(self, name):
         return self.pp.getObjList(name)
 
+    def getUnloadedProfiles(self):
+        return self.pp.getUnloaded()
+
     def addFileList(self, profile, rule_list):
         # At one point here we did this:
         #   norm_filename = profile.name.replace(".", "/").lstrip("/.")
@@ -83,13 +104,12 @@ class RuleList:
         # not matching properly, this is a good place to start looking
         norm_filename = profile.name.lstrip("\.")
 
-        if norm_filename not in self.log_parser.profile_names:
-            self.log_parser.profile_names.append(norm_filename)
+        self.log_parser.addName(norm_filename)
 
         if norm_filename not in self.file_rule_dict:
             self.file_rule_dict[norm_filename] = rule_list
             return
 
-        print("WARNING: addFileEntry has duplicate filenames, one was discarded") # XXX handle this better
+        GlobalLogger.warning("addFileEntry has duplicate filenames, one was discarded: %s", norm_filename) # XXX handle this better
         return
 
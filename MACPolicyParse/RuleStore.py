@@ -0,0 +1,82 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from .Glob import *
+
+#
+# Per-profile rule store, partitioned by rule type (the class of the rule
+# object) and keyed within each partition by the rule's canonical identity as
+# returned by getRuleKey(): the path for files, the capability name for
+# capabilities, family/type for network, etc.
+#
+# Every key can hold more than one object, since existing profiles are allowed to
+# repeat a rule. get() returns the first one added.
+#
+# Glob file rules can also be added to the store's PathIndex with addGlob(), so
+# covers() can tell whether a path is already granted by one of them.
+class RuleStore:
+    def __init__(self):
+        self.partitions = {}
+        self.path_index = PathIndex()
+
+    def getPartition(self, rtype):
+        if rtype not in self.partitions:
+            self.partitions[rtype] = {}
+
+        return self.partitions[rtype]
+
+    def add(self, obj, key=None):
+        if key == None:
+            key = obj.getRuleKey()
+
+        part = self.getPartition(type(obj))
+        if key not in part:
+            part[key] = []
+        part[key].append(obj)
+
+    def get(self, rtype, key):
+        part = self.partitions.get(rtype)
+        if not part or key not in part:
+            return None
+
+        return part[key][0]
+
+    def has(self, rtype, key):
+        return self.get(rtype, key) is not None
+
+    def remove(self, obj, key=None):
+        if key == None:
+            key = obj.getRuleKey()
+
+        objs = self.partitions[type(obj)][key]
+        objs.remove(obj)
+        if not objs:
+            del self.partitions[type(obj)][key]
+
+    def addGlob(self, path, perms):
+        self.path_index.add(path, perms)
+
+    def covers(self, path, perms):
+        return self.path_index.covers(path, perms)
+
+    def values(self):
+        for part in self.partitions.values():
+            for objs in part.values():
+                for obj in objs:
+                    yield obj
+
+    def __len__(self):
+        return sum(len(objs) for part in self.partitions.values() for objs in part.values())
@@ -14,11 +14,17 @@
 # limitations under the License.
 #
 
+import json
 import re
 import sys
 
 from .ProfileTypes import *
+from .LogTypes import *
 from .Filter import *
+from .Permissions import *
+from .Capabilities import *
+from .Metrics import *
+from .Util import *
 
 #
 # The checks in place here are for detection of security violations in AppArmor profiles.
@@ -63,20 +69,28 @@ class SecurityException:
         self.desc = description
         self.signoff = signoff
 
+        self.regex = re.compile(exception_regex)
+
         return
 
+# What an exception's regex is matched against
+#   ProfilePath - The profile's executable path, excepts the whole profile
+#   FullRegex - The full rule line that triggered the check
+exception_types = ["ProfilePath", "FullRegex"]
+
 #
 # Define specific rules for security violations
 #
-# @objtype - String indicating what type of object (File, Capability, Signal, Ptrace)
-# @rule - A list where rule[0] is the field in the object to check and rule[1] is a regex to check against.
+# @objtype - String indicating what type of object (File, Capability, Network, Signal, Ptrace)
+# @rule - A list where rule[0] is the field in the object to check and rule[1] is what to check it against.
 # @raw - Check against the raw rule string as generated by getDefaultRule(). In this case, use @rule[1] as a regex and
 #       @rule[0] is None
 #
-# The value of @rule[0] will depend on @objtype and define what is in @rule[1]. For instance, if @rule[0] is None, then
-#   @rule[1] will treat @rule[0] as a regex to match against the entire line. If @rule[0] is "Permissions" and @objtype
-#   is "File", then @rule[1] will be a list of permission characters to flag on (e.g. wx, mw). More of these will likely
-#   need to be added over time.
+# The value of @rule[0] will depend on @objtype and define what is in @rule[1], see check_table below for the
+#   supported pairs. If @rule[0] is None, then @rule[1] is a regex to match against the entire line.
+#
+# Non-raw checks run against the typed rule objects (FileRule/OpFile permission bitmasks, capability numbers, network
+#   families), only rules without a typed object fall back to parsing the rule line.
 #
 class SecurityCheckRule:
     def __init__(self, objtype, name, rule, msg, raw=False):
@@ -86,140 +100,426 @@ class SecurityCheckRule:
         self.msg = msg
         self.name = name
 
-    # TODO: We need to add some kind of delegation back to the object types here,
-    # as the list grows or changes. See the ProfileTypes.FileRule.isType() check
-    # below for example
-    def checkRule(self, rule):
-        if self.raw == True or self.rule[0] == None:
-            if re.search(self.rule[1], rule) == None:
-                return False
-            else:
-                return True
+        # Compiled once here, the checks run for every rule of every profile
+        self.regex = None
+        self.perms = None
+        self.caps = None
+        self.values = None
+        self.checker = None
 
-        rule_tag = self.rule[0]
-        rule_perms = self.rule[1]
+        if self.isRaw():
+            try:
+                self.regex = re.compile(self.rule[1])
+            except re.error as e:
+                GlobalLogger.fatal("Security check %s has an invalid regex: %s", self.name, str(e))
+            return
 
-        prule_type = self.getProfileType(rule)
+        method = check_table.get((self.objtype, self.rule[0]))
+        if method == None:
+            GlobalLogger.warning("Security check %s has an unsupported type: %s, %s", self.name, str(self.objtype), str(self.rule[0]))
+            return
 
-        # Skip unsupported
-        if prule_type == "None":
-            return False
+        self.checker = getattr(self, method)
 
-        if prule_type == "File" and self.objtype == "File":
-            if rule_tag == "Permissions":
-                perms = rule.lstrip().split()[1]
-                for rule_perm_char in rule_perms:
-                    if rule_perm_char not in perms:
-                        return False
-                return True
-        # XXX The below aren't handled currently and need to be implemented when
-        # needed, be sure to add them to getProfileType() below as well
-        elif self.objtype == "Capability":
-            return False
-        elif self.objtype == "Signal":
-            return False
-        elif self.objtype == "Ptrace":
+        data = self.rule[1]
+        if isinstance(data, str):
+            data = [data]
+
+        if method == "checkFilePermissions":
+            self.perms = FilePermissions.fromProfile(self.rule[1])
+        elif method == "checkFilePath":
+            self.regex = re.compile(self.rule[1])
+        elif method == "checkCapability":
+            self.caps = CapabilitySet.fromNames(data)
+        elif method == "checkNetworkFamily":
+            self.values = set(data)
+
+    def isRaw(self):
+        return self.raw == True or self.rule[0] == None
+
+    # Checks the rendered rule line alone, typed checks parse it back into values
+    def checkRule(self, rule):
+        return self.checkObject(None, rule)
+
+    # @obj - The typed rule object the line was rendered from, may be None
+    # @rule - The rendered rule line
+    def checkObject(self, obj, rule):
+        if self.isRaw():
+            return self.regex.search(rule) != None
+
+        if self.checker == None:
             return False
-        else:
-            print("WARNING: Unknown objtype passed into checkRule\n")
+
+        if getObjectType(obj, rule) != self.objtype:
             return False
 
-    def getProfileType(self, rule):
+        return self.checker(obj, rule)
+
+    def checkFilePermissions(self, obj, rule):
+        path, perms = fileValues(obj, rule)
+        return perms != None and perms.covers(self.perms)
+
+    def checkFilePath(self, obj, rule):
+        path, perms = fileValues(obj, rule)
+        return path != None and self.regex.search(path) != None
+
+    def checkCapability(self, obj, rule):
+        if isinstance(obj, (CapableRule, OpCapable)):
+            if obj.getCapability() != -1:
+                return self.caps.has(obj.getCapability())
+            return self.caps.hasName(obj.getDefaultRule().split()[-1])
+
+        tokens = rule.split()
+        # A bare "capability" allows all of them
+        if len(tokens) == 1:
+            return True
+        return self.caps.hasName(tokens[1])
+
+    def checkNetworkFamily(self, obj, rule):
+        if isinstance(obj, OpNetwork):
+            return obj.family.strip("\"") in self.values
+
+        tokens = rule.split()
+        # A bare "network" allows every family
+        if len(tokens) == 1:
+            return True
+        return tokens[1] in self.values
+
+    def checkAny(self, obj, rule):
+        return True
 
-        if not rule or not rule[1]:
-            print("WARNING: Empty rule passed to getProfileType")
+    def getProfileType(self, rule):
+        if not rule:
+            GlobalLogger.warning("Empty rule passed to getProfileType")
             return "None"
 
-        # TODO: This needs to be cleaned up so we can handle more than
-        # just file rules. Ideally delegate back to their obj types, but
-        # doing isType() wont work due to list validation
-        file_perm_list = ['r', 'w', 'm', 'x', 'a', 'c', 'd']
+        return getProfileType(rule)
+
+#
+# (objtype, check field) -> SecurityCheckRule method for the check
+#
+#   File, Permissions - rule[1] is a permission string, flags rules with all of them (e.g. "wx")
+#   File, Path - rule[1] is a regex matched against the path
+#   Capability, Capability - rule[1] is a capability name or list of names
+#   Network, Family - rule[1] is a network family or list of families (e.g. "packet")
+#   Signal, Any / Ptrace, Any - Flags any signal or ptrace rule, rule[1] is unused
+check_table = {
+    ("File", "Permissions"): "checkFilePermissions",
+    ("File", "Path"): "checkFilePath",
+    ("Capability", "Capability"): "checkCapability",
+    ("Network", "Family"): "checkNetworkFamily",
+    ("Signal", "Any"): "checkAny",
+    ("Ptrace", "Any"): "checkAny",
+}
+
+# Rule object class -> objtype
+object_types = {
+    FileRule: "File",
+    OpFile: "File",
+    CapableRule: "Capability",
+    OpCapable: "Capability",
+    OpNetwork: "Network",
+    SignalRule: "Signal",
+    OpSignal: "Signal",
+    PtraceRule: "Ptrace",
+    OpPtrace: "Ptrace",
+}
+
+#
+# Returns (path, permissions) for a rendered file rule, None for anything else
+def splitFileRule(rule):
+    tokens = rule.split()
+    if tokens and tokens[0] == "owner":
+        tokens = tokens[1:]
+
+    if len(tokens) != 2 or not tokens[0].startswith("/"):
+        return None
+
+    # TODO: This needs to be cleaned up so we can handle more than
+    # just file rules. Ideally delegate back to their obj types, but
+    # doing isType() wont work due to list validation
+    file_perm_list = ['r', 'w', 'm', 'x', 'a', 'c', 'd']
+    if not any(ele in tokens[1] for ele in file_perm_list):
+        return None
+
+    return tokens[0], tokens[1]
+
+# Returns (path, FilePermissions) for a file rule, (None, None) if it isn't one
+def fileValues(obj, rule):
+    if isinstance(obj, FileRule):
+        return obj.filename, obj.perms
+    # The log filters can rewrite the path when the rule is rendered, so the path
+    # comes from the rendered rule
+    if isinstance(obj, OpFile):
+        return rule.rsplit(None, 1)[0], obj.getPermissions()
+
+    parts = splitFileRule(rule)
+    if parts == None:
+        return None, None
+    return parts[0], FilePermissions.fromProfile(parts[1])
+
+# Rule type from the rendered line, for rules without a typed object
+def getProfileType(rule):
+    if splitFileRule(rule) != None:
+        return "File"
+
+    tokens = rule.split()
+    if tokens and tokens[0] in ("capability", "network", "signal", "ptrace"):
+        return tokens[0].capitalize()
+
+    return "None"
+
+def getObjectType(obj, rule):
+    objtype = object_types.get(type(obj))
+    if objtype == None:
+        return getProfileType(rule)
+    return objtype
+
+#
+# Returns the exception list indexed as {rule name: {exception type: [SecurityException]}},
+# multiple exceptions can share a rule name
+def loadExceptionList():
+    f = Filter("SecurityExceptionList")
+
+    exceptions = {}
+    for entry in f.loadFilterSet():
+        if entry.exception_type not in exception_types:
+            GlobalLogger.fatal("Security exception for %s has an unknown exception_type: %s", entry.rule_name, str(entry.exception_type))
+
+        exc = SecurityException(entry.rule_name, entry.exception_type, entry.exception_regex, entry.description, entry.signoff)
+        exceptions.setdefault(exc.rule_name, {}).setdefault(exc.exception_type, []).append(exc)
+
+    return exceptions
+
+def loadCheckList():
+    f = Filter("SecurityCheckList")
+
+    check_list = []
+    for entry in f.loadFilterSet():
+        check_list.append(SecurityCheckRule(entry.objtype, entry.name, entry.rule, entry.msg, entry.raw))
 
-        perm_result = [ele for ele in file_perm_list if(ele in rule[1])]
-        if rule[0].startswith("/") and bool(perm_result):
-            return "File"
-        return "None"
+    # The filter list is a set, keep the reporting order stable
+    check_list.sort(key=lambda x: x.name)
+    return check_list
 
+#
+# True if a raw check's compiled regex can go in the combined alternation. Inline
+# global flags (e.g. (?i)) would apply to every check or fail to compile in the middle
+# of it, group names must be unique and backreferences would point at the wrong group.
+def isCombinable(regex):
+    if regex.flags & ~re.UNICODE or regex.groupindex:
+        return False
+
+    return re.search(r"\\[1-9]|\(\?\(", regex.pattern) == None
+
+#
+# The check and exception lists are loaded and compiled once when this is created,
+# so a single SecurityCheck should be kept for the whole run.
+#
+# With fail_fast set (the default), the run stops at the first profile with a
+# violation. Otherwise violations are only recorded in the profile's violations
+# list, to be gathered in a SecurityReport.
+#
+# Checks are grouped by the rule type they apply to, and the raw regex checks that
+# allow it are combined into a single alternation used as a prefilter, so each rule
+# is classified once and most rules are cleared with a single regex search. The rest
+# are matched one by one.
 class SecurityCheck:
-    def __init__(self):
+    def __init__(self, check_list=None, exceptions=None, fail_fast=True):
         self.error = False
+        self.fail_fast = fail_fast
+
+        if check_list == None:
+            check_list = loadCheckList()
+        self.check_list = check_list
+        self.checks_by_name = {x.name: x for x in check_list}
+
+        if exceptions == None:
+            exceptions = loadExceptionList()
+        self.exceptions = exceptions
+
+        # (exe path, rule name) -> whether a ProfilePath exception covers it, these
+        # only depend on the profile so they're worked out once per profile
+        self.profile_exceptions = {}
+
+        # Rule type -> checks applying to it
+        self.type_checks = {}
+        self.raw_checks = []
+        # Raw checks that can't be combined with the others, see isCombinable()
+        self.raw_unmerged = []
+
+        for check in self.check_list:
+            if not check.isRaw():
+                self.type_checks.setdefault(check.objtype, []).append(check)
+            elif isCombinable(check.regex):
+                self.raw_checks.append(check)
+            else:
+                self.raw_unmerged.append(check)
+
+        self.raw_regex = None
+        if self.raw_checks:
+            try:
+                self.raw_regex = re.compile("|".join("(?:" + x.rule[1] + ")" for x in self.raw_checks))
+            except re.error:
+                GlobalLogger.debug("Raw security checks can't be combined, matching them one by one")
+                self.raw_unmerged = self.raw_checks + self.raw_unmerged
+                self.raw_checks = []
+
         return
 
     def failed(self, rule, exe_name, check):
-        print("\nSecurity violation found:")
-        print("-> Profile: " + exe_name)
-        print("--> Violation name: " + check.name)
-        print("--> Violation description: " + check.msg)
-        print("--> Line: " + rule + "\n")
-        print("\n")
+        GlobalLogger.error("Security violation found:\n-> Profile: %s\n--> Violation name: %s\n"
+                           "--> Violation description: %s\n--> Line: %s", exe_name, check.name, check.msg, rule)
 
         self.error = True
         return
 
+    # Yields every check that matches the rule, obj is the typed object the rule was
+    # rendered from (may be None)
+    def matchingChecks(self, rule, obj=None):
+        if self.raw_regex and self.raw_regex.search(rule):
+            for check in self.raw_checks:
+                if check.checkRule(rule):
+                    yield check
+
+        for check in self.raw_unmerged:
+            if check.checkRule(rule):
+                yield check
+
+        if self.type_checks:
+            objtype = getObjectType(obj, rule)
+            for check in self.type_checks.get(objtype, []):
+                if check.checker != None and check.checker(obj, rule):
+                    yield check
+
     # @profileobj - The OutputProfile object to scan for policy violations
+    #
+    # Returns the violations found, which are also set as profileobj.violations
     def checkProfile(self, profileobj):
-        f = Filter("SecurityCheckList")
-        check_list_tmp = f.loadFilterSet()
+        violations = []
+        profileobj.violations = violations
+
+        if not self.check_list:
+            if profileobj.security_verdicts != None:
+                profileobj.security_verdicts = {}
+            return violations
 
-        for entry in check_list_tmp:
-            check_list.append(SecurityCheckRule(entry.objtype, entry.name, entry.rule, entry.msg, entry.raw))
+        # Verdicts from the last run, see Fingerprint.SecurityCache
+        verdicts = profileobj.security_verdicts
+        new_verdicts = None
+        if verdicts != None:
+            new_verdicts = {}
 
-        # Operate on raw text rules
+        # Typed checks use the objects the rules were rendered from
         for rule in profileobj.rule_list:
-            for check in check_list:
-                if check.checkRule(rule) == True:
+            if verdicts != None and rule in verdicts:
+                matched = [self.checks_by_name[x] for x in verdicts[rule] if x in self.checks_by_name]
+            else:
+                matched = []
+                for check in self.matchingChecks(rule, profileobj.raw_dict.get(rule)):
                     # Rule match, check for exceptions
                     if self.checkExceptions(rule, check, profileobj) == True:
                         # We have an exception or no match, move on
                         continue
-                    else:
-                        # Rule match, no exception, error out
-                        self.failed(rule, profileobj.exe_name, check)
-                        continue
-        if self.error == True:
-            print("Rule generation failed due to security violations.\n")
-            sys.exit(0)
-        return
+                    matched.append(check)
+
+            if new_verdicts != None:
+                new_verdicts[rule] = [x.name for x in matched]
+
+            # Rule match, no exception
+            for check in matched:
+                violations.append({"check": check.name, "description": check.msg, "rule": rule})
+                GlobalMetrics.violations.inc(1, (check.name,))
+                if self.fail_fast:
+                    self.failed(rule, profileobj.exe_name, check)
+
+        profileobj.security_verdicts = new_verdicts
+
+        if violations and self.fail_fast:
+            GlobalLogger.fatal("Rule generation failed due to security violations.")
+        return violations
 
     # True on match
     def checkExceptions(self, rule, check, profileobj):
-        f = Filter("SecurityExceptionList")
-        e_list_tmp = f.loadFilterSet()
-
-        for entry in e_list_tmp:
-            exception_list.append(SecurityException(entry.rule_name, entry.exception_type, entry.exception_regex, entry.description, entry.signoff))
-
-        # It would be more effective to index them as a dictionary but
-        # then we lose the chance to have two named the same, so keep it this way
-        #
-        # Gather the list of exceptions that match our current name
-        named_list = []
-        for exc in exception_list:
-            if exc.rule_name == check.name:
-                named_list.append(exc)
-
-        # Now check them
-        #
+        named = self.exceptions.get(check.name)
+        if not named:
+            return False
+
         # Similar to the check types, the options here will likely need to grow
         # as need for different types of exceptions is found.
-        for exc in named_list:
-            # XXX Add check to make sure rule is a string
-            if exc.exception_type == "ProfilePath":
-                if re.search(exc.exception_regex, profileobj.exe_name) != None:
-                    print("Exception Found")
-                    return True
-            elif exc.exception_type == "FullRegex":
-                for rule in profile.rule_list:
-                    if re.search(exc.exception_regex, rule) != None:
-                        print("Exception Found")
-                        return True
-            else:
-                print("ERROR: checkExceptions() exception_type is unknown.\n")
-                sys.exit(0)
-                return False
-            return False
-        return False
+        key = (profileobj.exe_name, check.name)
+        excepted = self.profile_exceptions.get(key)
+        if excepted == None:
+            excepted = False
+            for exc in named.get("ProfilePath", []):
+                if exc.regex.search(profileobj.exe_name) != None:
+                    excepted = True
+                    break
+            self.profile_exceptions[key] = excepted
+
+        if not excepted:
+            for exc in named.get("FullRegex", []):
+                if exc.regex.search(rule) != None:
+                    excepted = True
+                    break
+
+        if excepted:
+            GlobalLogger.debug("Exception Found")
+
+        return excepted
+
+#
+# Security violations gathered across the whole run, see SecurityCheck fail_fast
+class SecurityReport:
+    def __init__(self):
+        self.checked = 0
+        # Profile name -> {"exe_path", "violations"}, only for profiles that failed
+        self.profiles = {}
+
+    def addProfile(self, name, exe_path, violations):
+        self.checked += 1
+        if violations:
+            self.profiles[name] = {"exe_path": exe_path, "violations": violations}
+
+    def hasViolations(self):
+        return len(self.profiles) > 0
+
+    def getSummary(self):
+        by_check = {}
+        total = 0
+        for entry in self.profiles.values():
+            for v in entry["violations"]:
+                by_check[v["check"]] = by_check.get(v["check"], 0) + 1
+                total += 1
+
+        return {
+            "profiles_checked": self.checked,
+            "profiles_failed": len(self.profiles),
+            "violations": total,
+            "by_check": dict(sorted(by_check.items())),
+        }
+
+    def printSummary(self):
+        summary = self.getSummary()
+
+        print("******** Security Check Results *********")
+        for name, entry in self.profiles.items():
+            print("\n-> Profile: " + name + " (" + str(entry["exe_path"]) + ")")
+            for v in entry["violations"]:
+                print("--> " + v["check"] + ": " + v["description"])
+                print("    Line: " + v["rule"])
+
+        print(f"\nChecked {str(summary['profiles_checked'])} profiles, {str(summary['violations'])} violations in {str(summary['profiles_failed'])} profiles")
+        for check, count in summary["by_check"].items():
+            print(f"  {check}: {str(count)}")
+
+    def toDict(self):
+        profiles = []
+        for name, entry in self.profiles.items():
+            profiles.append({"name": name, "exe_path": entry["exe_path"], "violations": entry["violations"]})
 
-check_list = []
+        return {"summary": self.getSummary(), "profiles": profiles}
 
-exception_list = []
+    def writeJSON(self, fp):
+        json.dump(self.toDict(), fp, indent=1)
+        fp.write("\n")
@@ -14,86 +14,174 @@
 # limitations under the License.
 #
 
-GlobalLogger = None
+
+import sys
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
 
 # Global logger for tracking warnings, errors, and security violations.
 #
 # Basically provides a cleaner, easier to trace interface that using print(), also
 # allows us to output details to a file rather than just to the console
 #
+# Messages are buffered and written by flush(), with repeats of the same message
+# format collapsed into the first one and a count, so a warning hit for every log
+# entry is one line. Formatting is deferred until a message is first kept, and
+# messages below the level are dropped before anything else is done, so with the
+# level at ERROR (--quiet) logging on hot paths costs next to nothing. Errors are
+# always kept individually.
+#
 # Warning example:
 # -            print("ERROR: Path is directory, skipping")
 # -            print("Path: " + path + filename)
-# +            GlobalLogger.addWarning("ProfileParser", "LoadDir", "Specified path is a directory, skipping: " + path + filename)
+# +            GlobalLogger.error("Path is directory, skipping: %s", path + filename)
 #
-# Error example:
-# -        print("WARNING: Pure virtual to Profile.getDefaultRule")
-# +        GlobalLogger.addError("ProfileBaseOp", "Pure Virtual", "Pure virtual call to base_op: isDuplicate", True)
-
-
+# Manual edit example:
+# -            print("**** MANUAL EDIT REQUIRED ****")
+# -            print("WARNING: Empty filename, appending to lostandfound")
+# +            GlobalLogger.addManualEdit(op.name, "Empty filename, appending to lostandfound")
+#
+# With buffered off (--verbose) every message is written as it happens instead.
+#
+# Messages go to stderr unless fp is set, so stdout only carries the profiles and
+# reports that were asked for.
 class Logging:
-    def __init__(self, write_dir):
-        self.manual_edit_buf = {}
-
-        self.warning_buffer = {}
-        self.error_buffer = {}
-
-        global GlobalLogger = self
-
-    def addWarning(self, profile, name, message):
-        if not self.warning_buffer[profile]:
-            self.warning_buffer[profile] = []
+    def __init__(self, level=INFO, buffered=True, fp=None):
+        self.level = level
+        self.buffered = buffered
+        self.fp = fp
+
+        # {(level, format): [count, first message]}
+        self.records = {}
+        # [(name, message)]
+        self.manual_edits = []
+
+    def configure(self, level=None, buffered=None):
+        if level != None:
+            self.level = level
+        if buffered != None:
+            self.buffered = buffered
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+
+        if not self.buffered:
+            self.emit(level, msg % args if args else msg)
+            return
+
+        key = (level, msg)
+        rec = self.records.get(key)
+        if rec != None and level < ERROR:
+            rec[0] += 1
+            return
+
+        text = msg % args if args else msg
+        if level >= ERROR:
+            key = (level, text)
+            rec = self.records.get(key)
+            if rec != None:
+                rec[0] += 1
+                return
+
+        self.records[key] = [1, text]
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    # Logs the error, writes out everything buffered and exits with an error status
+    def fatal(self, msg, *args):
+        self.log(ERROR, msg, *args)
+        self.flush()
+        sys.exit(1)
 
-        self.warning_buffer[profile].append(name + " : " + msg)
-
-    def outputWarnings(self):
-        print("******** WARNINGS ************\n")
+    # Track lines that need to be manually edited. These aren't warnings or
+    # errors, just things that need to be revisited and cleaned up
+    def addManualEdit(self, name, msg, *args):
+        if WARNING < self.level:
+            return
 
-        for warn in self.warning_buffer:
-            print(warn + " : " + self.warning_buffer[profile])
+        text = msg % args if args else msg
+        if not self.buffered:
+            self.emit(WARNING, "MANUAL EDIT REQUIRED: " + name + ": " + text)
+            return
 
-        print("******** END WARNINGS ************\n")
+        self.manual_edits.append((name, text))
 
-        return
+    def emit(self, level, text):
+        fp = self.fp
+        if fp == None:
+            fp = sys.stderr
 
-    def addError(self, profile, name, message, exit=True):
-        if not self.error_buffer[profile]:
-            self.error_buffer[profile] = []
+        if level == INFO:
+            fp.write(text + "\n")
+        else:
+            fp.write(level_names[level] + ": " + text + "\n")
 
-        self.error_buffer[profile].append(name + " : " + msg)
+    def outputManualEdits(self):
+        if not self.manual_edits:
+            return
 
-        if exit == True:
-            self.outputAll()
-            print("\n")
-            print("Profile generation failed due to fatal errors.\n")
-            sys.exit(0)
+        self.emit(INFO, "******** MANUAL EDITS REQUIRED ********")
+        for name, text in self.manual_edits:
+            self.emit(INFO, "= " + name + ": " + text)
+        self.emit(INFO, "******** END MANUAL EDITS *********")
 
-    def outputErrors(self):
-        print("********* FATAL ERRORS *********\n")
-        for err in self.error_buffer:
-            print(err + " : " + self.error_buffer[profile])
+    # Writes out and clears everything buffered
+    def flush(self):
+        self.outputManualEdits()
 
-        print("******** END ERRORS **********\n")
+        for (level, msg), (count, text) in self.records.items():
+            if count > 1:
+                text += f" (and {str(count - 1)} more like this)"
+            self.emit(level, text)
 
-        return
+        self.reset()
 
-    # Track lines that need to be manually edited. These aren't warnings or
-    # errors, just things that need to be revisited and cleaned up
-    def addManualEdit(self, name, msg):
-        self.manual_edit_buf.append(name + " : " + msg)
-
-    def outputManualEdits(self, fp):
+        fp = self.fp
         if fp == None:
-            # To console
-
-            for msg in self.manual_edit_buf:
-                print("= " + msg)
-
-            print("******** END MANUAL EDITS *********")
-
-    def outputAll(self):
-        self.outputManualEdits(None)
-        self.outputWarnings()
-        self.outputErrors()
-
-        return
+            fp = sys.stderr
+        fp.flush()
+
+    def reset(self):
+        self.records = {}
+        self.manual_edits = []
+
+    #
+    # Returns what's buffered so far and starts over, used to ship messages from
+    # worker processes to the parent, which adds them with mergeRecords()
+    def takeRecords(self):
+        taken = (list(self.records.items()), self.manual_edits)
+        self.reset()
+        return taken
+
+    def mergeRecords(self, taken):
+        records, manual_edits = taken
+
+        for key, (count, text) in records:
+            rec = self.records.get(key)
+            if rec != None:
+                rec[0] += count
+            else:
+                self.records[key] = [count, text]
+
+        self.manual_edits.extend(manual_edits)
+
+GlobalLogger = Logging()
@@ -0,0 +1,261 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import bisect
+import os
+import random
+
+# Cumulative Zipf weights for ranks 1 to count
+def zipfWeights(count, exponent):
+    weights = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / (rank ** exponent)
+        weights.append(total)
+    return weights
+
+#
+# Synthetic workloads, for benchmarks and testing at scale
+#
+# Generates a profile directory and a matching audit log in the format handled by
+# LogParser.ParseAppArmorMessage, with the kinds of entries seen on real devices:
+# file, capability, network, signal and ptrace operations, hex encoded file names,
+# shared libraries with changing versions, /proc/<pid> paths, and profile names
+# given as the profile name, its exe path or with //null-N child suffixes.
+#
+# @profiles - Number of profiles
+# @events - Number of log lines
+# @zipf - Exponent for profile popularity, log lines are spread over the profiles
+#   following a Zipf distribution (0 for uniform)
+# @path_zipf - Exponent for path popularity within a profile, the data files,
+#   libraries, pids and so on a profile touches are picked following a Zipf
+#   distribution too, so a few paths are hit far more than the rest (0 for uniform)
+# @repeat_rate - Chance a log line repeats one of the profile's recent events, as
+#   happens when a process keeps hitting the same access
+# @rules_per_profile - Number of rules in each profile file
+# @new_profile_rate - Fraction of the profiles that only appear in the log
+# @mix - {operation type: weight}, see default_mix
+# @seed - The same seed and settings always give the same workload
+#
+# Log lines are generated on the fly, so the log can be far larger than memory.
+class Workload:
+    default_mix = {
+        "file": 70,
+        "capability": 10,
+        "network": 8,
+        "signal": 6,
+        "ptrace": 6,
+    }
+
+    capabilities = [(0, "chown"), (1, "dac_override"), (2, "dac_read_search"), (5, "kill"),
+                    (6, "setgid"), (7, "setuid"), (12, "net_admin"), (13, "net_raw"),
+                    (21, "sys_admin"), (24, "sys_resource")]
+    families = [("inet", "stream"), ("inet", "dgram"), ("inet6", "stream"), ("unix", "stream"),
+                ("netlink", "raw"), ("packet", "raw")]
+    signals = ["term", "kill", "hup", "usr1", "int"]
+    masks = ["r", "r", "r", "w", "rw", "m", "rm", "a", "k"]
+
+    # Recent events kept per profile for repeats
+    history_size = 16
+
+    def __init__(self, profiles=100, events=10000, zipf=1.1, repeat_rate=0.3, rules_per_profile=10,
+                 new_profile_rate=0.05, mix=None, seed=1, path_zipf=1.1):
+        self.profiles = profiles
+        self.events = events
+        self.zipf = zipf
+        self.path_zipf = path_zipf
+        self.repeat_rate = repeat_rate
+        self.rules_per_profile = rules_per_profile
+        self.new_profile_rate = new_profile_rate
+        self.seed = seed
+
+        if mix == None:
+            mix = self.default_mix
+        self.mix_types = list(mix)
+        self.mix_weights = []
+        total = 0
+        for op_type in self.mix_types:
+            total += mix[op_type]
+            self.mix_weights.append(total)
+
+        # Cumulative Zipf weights by profile rank
+        self.popularity = zipfWeights(profiles, zipf)
+
+        # Number of choices -> cumulative Zipf weights for picking paths, see pickPath()
+        self.path_popularity = {}
+
+    def getProfileName(self, idx):
+        return f"app{idx}"
+
+    def getExePath(self, idx):
+        return f"/usr/bin/app{idx}"
+
+    def getProfileFilename(self, idx):
+        return f"usr.bin.app{idx}"
+
+    # The last profiles are the ones without a profile file
+    def hasProfileFile(self, idx):
+        return idx < self.profiles - int(self.profiles * self.new_profile_rate)
+
+    def pickWeighted(self, rnd, cumulative):
+        return bisect.bisect_right(cumulative, rnd.random() * cumulative[-1])
+
+    # Picks one of count choices by path popularity, lower indexes are more popular
+    def pickPath(self, rnd, count):
+        if self.path_zipf == 0:
+            return rnd.randrange(count)
+
+        cumulative = self.path_popularity.get(count)
+        if cumulative == None:
+            cumulative = zipfWeights(count, self.path_zipf)
+            self.path_popularity[count] = cumulative
+        return self.pickWeighted(rnd, cumulative)
+
+    #
+    # Profile files
+    def writeProfiles(self, path):
+        rnd = random.Random(self.seed)
+        os.makedirs(path, exist_ok=True)
+
+        written = 0
+        for idx in range(self.profiles):
+            if not self.hasProfileFile(idx):
+                continue
+
+            with open(os.path.join(path, self.getProfileFilename(idx)), "w") as fp:
+                fp.write(f"profile {self.getProfileName(idx)} {self.getExePath(idx)} {{\n")
+                fp.write("    #include <abstractions/base>\n")
+                for n in range(self.rules_per_profile):
+                    fp.write("    " + self.profileRule(rnd, idx, n) + ",\n")
+                fp.write("}\n")
+            written += 1
+
+        return written
+
+    def profileRule(self, rnd, idx, n):
+        kind = n % 10
+        if kind == 7:
+            return "capability " + rnd.choice(self.capabilities)[1]
+        if kind == 8:
+            return "network " + rnd.choice(self.families)[0]
+        if kind == 9:
+            return f"/var/lib/app{idx}/** rw"
+
+        # Overlaps with the paths in the log, so merging has something to do
+        return self.filePath(rnd, idx) + " " + rnd.choice(self.masks)
+
+    #
+    # Log lines
+    def iterLogLines(self):
+        rnd = random.Random(self.seed + 1)
+        history = {}
+
+        for serial in range(self.events):
+            idx = self.pickWeighted(rnd, self.popularity)
+
+            recent = history.get(idx)
+            if recent and rnd.random() < self.repeat_rate:
+                body = rnd.choice(recent)
+            else:
+                body = self.logBody(rnd, idx)
+                if recent == None:
+                    recent = []
+                    history[idx] = recent
+                if len(recent) >= self.history_size:
+                    recent[rnd.randrange(self.history_size)] = body
+                else:
+                    recent.append(body)
+
+            uptime = 1000 + serial / 100.0
+            yield (f"[{uptime:12.6f}] audit: type=1400 audit(1663719518.{serial % 1000:03d}:{serial}): "
+                   f"apparmor=\"ALLOWED\" {body}\n")
+
+    # Returns the number of lines written
+    def writeLog(self, path):
+        count = 0
+        with open(path, "w") as fp:
+            for line in self.iterLogLines():
+                fp.write(line)
+                count += 1
+        return count
+
+    def logProfileName(self, rnd, idx):
+        roll = rnd.random()
+        if roll < 0.6:
+            return self.getProfileName(idx)
+        if roll < 0.9:
+            return self.getExePath(idx)
+        return self.getExePath(idx) + f"//null-{rnd.randrange(1, 40)}"
+
+    def logBody(self, rnd, idx):
+        op_type = self.mix_types[self.pickWeighted(rnd, self.mix_weights)]
+        common = f"profile=\"{self.logProfileName(rnd, idx)}\" pid={rnd.randrange(100, 32768)} comm=\"app{idx}\""
+
+        if op_type == "file":
+            name = "\"" + self.filePath(rnd, idx) + "\""
+            # The kernel hex encodes names with unusual characters
+            if rnd.random() < 0.02:
+                name = f"/tmp/app{idx} cache {rnd.randrange(100)}".encode().hex().upper()
+            mask = rnd.choice(self.masks)
+            return (f"operation=\"open\" {common} name={name} requested_mask=\"{mask}\" "
+                    f"denied_mask=\"{mask}\" fsuid=0 ouid=0")
+
+        if op_type == "capability":
+            num, name = rnd.choice(self.capabilities)
+            return f"operation=\"capable\" {common} capability={num} capname=\"{name}\""
+
+        if op_type == "network":
+            family, sock_type = rnd.choice(self.families)
+            return (f"operation=\"create\" {common} family=\"{family}\" sock_type=\"{sock_type}\" "
+                    f"protocol=0 requested_mask=\"create\" denied_mask=\"create\"")
+
+        if op_type == "signal":
+            signal = rnd.choice(self.signals)
+            return (f"operation=\"signal\" {common} requested_mask=\"send\" denied_mask=\"send\" "
+                    f"signal={signal} peer=\"unconfined\"")
+
+        return f"operation=\"ptrace\" {common} requested_mask=\"read\" denied_mask=\"read\" peer=\"unconfined\""
+
+    etc_files = ["ld.so.cache", "passwd", "group", "hosts", "nsswitch.conf", "localtime"]
+
+    def filePath(self, rnd, idx):
+        roll = rnd.random()
+        if roll < 0.35:
+            return f"/opt/app{idx}/data/file{self.pickPath(rnd, 50)}"
+        if roll < 0.55:
+            # Shared libraries, with the versions changing between builds
+            lib = self.pickPath(rnd, 40)
+            return f"/usr/lib/libdep{lib}.so.{rnd.randrange(3)}.{rnd.randrange(10)}.{rnd.randrange(20)}"
+        if roll < 0.7:
+            return f"/proc/{100 + self.pickPath(rnd, 32668)}/" + rnd.choice(["status", "stat", "cmdline", "fd/"])
+        if roll < 0.85:
+            etc = self.pickPath(rnd, len(self.etc_files) + 1)
+            if etc == len(self.etc_files):
+                return f"/etc/app{idx}.conf"
+            return "/etc/" + self.etc_files[etc]
+        return f"/tmp/app{idx}.{self.pickPath(rnd, 20)}"
+
+    #
+    # Writes the profiles to <path>/profiles/ and the log to <path>/audit.log, returns
+    # (profile dir, log path)
+    def generate(self, path):
+        profile_dir = os.path.join(path, "profiles") + "/"
+        log_path = os.path.join(path, "audit.log")
+
+        self.writeProfiles(profile_dir)
+        self.writeLog(log_path)
+
+        return profile_dir, log_path
@@ -16,10 +16,18 @@
 
 from .RuleList import RuleList
 from .LogParser import ParseAppArmorMessage
-from .OutputProfile import GenProfiles
+from .OutputProfile import GenProfiles, OutputInclude
+from .Fingerprint import ProfileCache, SecurityCache
+from .OutputWriter import OutputWriter
+from .OutputBundle import OutputBundle
+from .Diff import DiffReport
+from .Workload import Workload
+from .Profiling import RunProfiler
+from .Metrics import GlobalMetrics, MetricsExporter
+from .Util import Logging, GlobalLogger
 
 version_info = (0, 0, 1)
 __version__ = '.'.join(map(str, version_info))
 __author__ = ""
 
-__all__ = ["RuleList", "ParseAppArmorMessage", "GenProfiles"]
+__all__ = ["RuleList", "ParseAppArmorMessage", "GenProfiles", "OutputInclude", "ProfileCache", "SecurityCache", "OutputWriter", "OutputBundle", "DiffReport", "Workload", "RunProfiler", "GlobalMetrics", "MetricsExporter", "Logging", "GlobalLogger"]
@@ -22,8 +22,15 @@
  # 3 - Msg/Desc - Message or description for this alert
  # 4 - Raw - Only used if the detection is a raw regex against the entire line (CheckType would be None in this case)
  #
+ # Supported (CheckType, CheckData) pairs per resource type (see SecurityCheck.check_table):
+ #   File - ("Permissions", "wx") flags rules with all of the permissions, ("Path", regex) matches the path
+ #   Capability - ("Capability", name or [names])
+ #   Network - ("Family", family or [families])
+ #   Signal, Ptrace - ("Any", None) flags any signal/ptrace rule
+ #
  # For example:
  # SecurityCheckRuleTemp("Capability", "CAP_DACOVERRIDE", (None, "/.*dac_override.*/"), "DAC_OVERRIDE allowed", True),
+ # SecurityCheckRuleTemp("Capability", "CAP_SYSADMIN", ("Capability", ["sys_admin", "sys_module"]), "SYS_ADMIN allowed"),
  #
 class SecurityCheckRuleTemp:
     def __init__(self, objtype, name, rule, msg, raw=False):
@@ -0,0 +1,296 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Benchmarks for each stage of the pipeline, at several input sizes
+#
+# Run from the repository root (the filter lists are loaded relative to it):
+#   ./benchmark.py --scales 100,1000 --output results.json
+#   ./benchmark.py --baseline results.json
+#
+# Times are the best of --repeat runs. Peak memory is measured in a separate run under
+# tracemalloc, since tracing slows everything down. With --baseline, stages that got
+# slower or use more memory than the baseline by more than --threshold are reported as
+# regressions and the exit code is 1.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from MACPolicyParse import GenProfiles, ParseAppArmorMessage, Workload, GlobalLogger
+from MACPolicyParse.LogParser import LogParser
+from MACPolicyParse.ProfileParser import ProfileParser
+from MACPolicyParse.SecurityCheck import SecurityCheck, SecurityCheckRule
+from MACPolicyParse.Util import ERROR
+
+benchmark_format = 2
+
+# Representative checks, the shipped SecurityCheckList is empty
+bench_checks = [
+    SecurityCheckRule("File", "BENCH_WX", ("Permissions", "wx"), "Writable and executable"),
+    SecurityCheckRule("File", "BENCH_TMP", ("Path", "^/tmp/"), "Access to /tmp"),
+    SecurityCheckRule("Capability", "BENCH_CAP", ("Capability", ["sys_admin", "sys_module"]), "Admin capability"),
+    SecurityCheckRule("Network", "BENCH_NET", ("Family", "packet"), "Packet sockets"),
+    SecurityCheckRule("Capability", "BENCH_RAW", (None, "dac_override"), "DAC override", True),
+]
+
+#
+# Each stage has a setup, which isn't measured, and a run that gets the setup's result
+# and returns how many items it processed
+class Stages:
+    def __init__(self, profile_dir, log_path):
+        self.profile_dir = profile_dir
+        self.log_path = log_path
+
+        with open(log_path, "r") as fp:
+            self.lines = fp.readlines()
+
+    def newGen(self, diff=False):
+        gen = GenProfiles(diff=diff)
+        gen.ParseExistingProfiles(self.profile_dir, None)
+        gen.ParseLogFile(self.log_path)
+        return gen
+
+    def setupNone(self):
+        return None
+
+    def runParse(self, state):
+        for line in self.lines:
+            ParseAppArmorMessage(line).parse(line)
+        return len(self.lines)
+
+    def runParseToObj(self, state):
+        for line in self.lines:
+            ParseAppArmorMessage(line).parseToObj(line)
+        return len(self.lines)
+
+    def runParseLogfile(self, state):
+        LogParser().parseLogfile(self.log_path)
+        return len(self.lines)
+
+    def runLoadProfilesDir(self, state):
+        pp = ProfileParser()
+        pp.loadProfilesDir(self.profile_dir, None)
+        for name in pp.getNameList():
+            pp.getObjList(name)
+        return len(pp.getNameList())
+
+    def setupDeDuplicate(self):
+        gen = self.newGen()
+        work = []
+        for name in gen.GetNames():
+            log_entries = gen.GetLogEntriesForName(name)
+            profile_entries = gen.GetProfileEntriesForName(name)
+            if log_entries:
+                work.append((log_entries, gen.deDuplicate_Profile(profile_entries or [])))
+        return gen, work
+
+    def runDeDuplicate(self, state):
+        gen, work = state
+        items = 0
+        for log_entries, profilelist in work:
+            gen.deDuplicate_Log(log_entries, profilelist)
+            items += len(log_entries)
+        return items
+
+    def setupGenerate(self):
+        return self.newGen()
+
+    def runGenerate(self, gen):
+        return len(gen.generatePolicyFileList())
+
+    def setupSecurityCheck(self):
+        return self.newGen().generateOutputProfiles()
+
+    def runSecurityCheck(self, opl):
+        sc = SecurityCheck(check_list=bench_checks, fail_fast=False)
+        items = 0
+        for op in opl:
+            sc.checkProfile(op)
+            items += len(op.rule_list)
+        return items
+
+    def setupDiff(self):
+        gen = self.newGen(diff=True)
+        return gen, gen.generatePolicyFileList()
+
+    def runDiff(self, state):
+        gen, entries = state
+        for entry in entries:
+            gen.diffPolicyFile(entry)
+        return len(entries)
+
+    def getStages(self):
+        return [
+            ("ParseAppArmorMessage.parse", self.setupNone, self.runParse),
+            ("ParseAppArmorMessage.parseToObj", self.setupNone, self.runParseToObj),
+            ("LogParser.parseLogfile", self.setupNone, self.runParseLogfile),
+            ("ProfileParser.loadProfilesDir", self.setupNone, self.runLoadProfilesDir),
+            ("GenProfiles.deDuplicate_Log", self.setupDeDuplicate, self.runDeDuplicate),
+            ("GenProfiles.generatePolicyFileList", self.setupGenerate, self.runGenerate),
+            ("SecurityCheck.checkProfile", self.setupSecurityCheck, self.runSecurityCheck),
+            ("GenProfiles.diffPolicyFile", self.setupDiff, self.runDiff),
+        ]
+
+#
+# Returns {"seconds", "peak_bytes", "items", "items_per_sec"} for one stage
+def measure(setup, run, repeat):
+    best = None
+    items = 0
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            items = run(state)
+            elapsed = time.perf_counter() - start
+            if best == None or elapsed < best:
+                best = elapsed
+
+        state = setup()
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "seconds": best,
+        "peak_bytes": peak,
+        "items": items,
+        "items_per_sec": items / best if best else 0,
+    }
+
+def runBenchmarks(scales, events, zipf, path_zipf, repeat_rate, repeat, stage_filter):
+    results = []
+
+    for scale in scales:
+        tmp_dir = tempfile.mkdtemp(prefix="macpp_bench")
+        try:
+            workload = Workload(profiles=scale, events=scale * events, zipf=zipf, repeat_rate=repeat_rate,
+                                path_zipf=path_zipf)
+            profile_dir, log_path = workload.generate(tmp_dir)
+            stages = Stages(profile_dir, log_path)
+
+            for name, setup, run in stages.getStages():
+                if stage_filter and not any(x in name for x in stage_filter):
+                    continue
+
+                result = measure(setup, run, repeat)
+                result["stage"] = name
+                result["scale"] = scale
+                results.append(result)
+
+                print(f"{name:38} {scale:>7} {result['seconds']:>10.4f}s {result['peak_bytes'] / 1048576:>9.2f}MB {result['items_per_sec']:>12.0f}/s")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    return results
+
+# Stages faster/smaller than these in the baseline are too noisy to compare
+min_seconds = 0.01
+min_peak_bytes = 1048576
+
+#
+# Returns a list of regression messages for results that are worse than the baseline
+# by more than threshold (a fraction)
+def compareBaseline(results, baseline, threshold):
+    base = {}
+    for entry in baseline["results"]:
+        base[(entry["stage"], entry["scale"])] = entry
+
+    regressions = []
+    for entry in results:
+        old = base.get((entry["stage"], entry["scale"]))
+        if old == None:
+            continue
+
+        for key, label, floor in [("seconds", "time", min_seconds), ("peak_bytes", "peak memory", min_peak_bytes)]:
+            if old[key] < floor:
+                continue
+            if entry[key] > old[key] * (1 + threshold):
+                regressions.append(f"{entry['stage']} at scale {str(entry['scale'])}: {label} {entry[key] / old[key]:.2f}x the baseline")
+
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scales", help="Comma separated list of profile counts to run at", default="100,1000")
+    ap.add_argument("--events", help="Log lines per profile", type=int, default=20)
+    ap.add_argument("--zipf", help="Zipf exponent for how log lines are spread over profiles (0 for uniform)", type=float, default=1.1)
+    ap.add_argument("--path_zipf", help="Zipf exponent for how often each path of a profile is used (0 for uniform)", type=float, default=1.1)
+    ap.add_argument("--repeat_rate", help="Chance a log line repeats a recent event of the same profile", type=float, default=0.3)
+    ap.add_argument("--repeat", help="Runs per stage, the best time is kept", type=int, default=3)
+    ap.add_argument("--stages", help="Comma separated list of stage names (or parts of them) to run", required=False)
+    ap.add_argument("--output", help="Writes the results as JSON to <file>", required=False)
+    ap.add_argument("--baseline", help="Compares the results to an earlier --output file", required=False)
+    ap.add_argument("--threshold", help="Fraction a stage may be slower/bigger than the baseline before it is flagged", type=float, default=0.2)
+
+    args = ap.parse_args()
+
+    # Messages would otherwise be buffered across every repeat of every stage
+    GlobalLogger.configure(level=ERROR)
+
+    scales = [int(x) for x in args.scales.split(",")]
+    stage_filter = None
+    if args.stages:
+        stage_filter = args.stages.split(",")
+
+    print(f"{'Stage':38} {'Scale':>7} {'Time':>11} {'Peak':>11} {'Rate':>14}")
+    results = runBenchmarks(scales, args.events, args.zipf, args.path_zipf, args.repeat_rate, args.repeat, stage_filter)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({
+                "format": benchmark_format,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "events": args.events,
+                "zipf": args.zipf,
+                "path_zipf": args.path_zipf,
+                "repeat_rate": args.repeat_rate,
+                "results": results,
+            }, fp, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+
+        if baseline.get("format") != benchmark_format:
+            print("WARNING: Baseline was made with a different workload generator, results may not be comparable")
+        for key in ["events", "zipf", "path_zipf", "repeat_rate"]:
+            if baseline.get(key) != getattr(args, key):
+                print(f"WARNING: Baseline was run with a different --{key}, results may not be comparable")
+
+        regressions = compareBaseline(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions against " + args.baseline + ":")
+            for msg in regressions:
+                print("  " + msg)
+            return 1
+
+        print("\nNo regressions against " + args.baseline)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
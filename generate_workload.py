@@ -0,0 +1,62 @@
+#
+# Copyright 2023 Comcast Cable Communications Management, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Writes a synthetic profile directory and audit log, see MACPolicyParse.Workload
+#   ./generate_workload.py --profiles 1000 --events 100000 <out dir>
+
+import argparse
+import os
+import sys
+
+from MACPolicyParse import Workload
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("out_dir", help="Directory to write profiles/ and audit.log to", nargs="?")
+    ap.add_argument("--profiles", help="Number of profiles", type=int, default=100)
+    ap.add_argument("--events", help="Number of log lines", type=int, default=10000)
+    ap.add_argument("--zipf", help="Zipf exponent for how log lines are spread over profiles (0 for uniform)", type=float, default=1.1)
+    ap.add_argument("--path_zipf", help="Zipf exponent for how often each path of a profile is used (0 for uniform)", type=float, default=1.1)
+    ap.add_argument("--repeat_rate", help="Chance a log line repeats a recent event of the same profile", type=float, default=0.3)
+    ap.add_argument("--rules", help="Number of rules in each profile", type=int, default=10)
+    ap.add_argument("--new_profiles", help="Fraction of profiles that only appear in the log", type=float, default=0.05)
+    ap.add_argument("--seed", help="Random seed", type=int, default=1)
+    ap.add_argument("--log_only", help="Only write the log, to stdout", action="store_true")
+
+    args = ap.parse_args()
+
+    wl = Workload(profiles=args.profiles, events=args.events, zipf=args.zipf, repeat_rate=args.repeat_rate,
+                  rules_per_profile=args.rules, new_profile_rate=args.new_profiles, seed=args.seed,
+                  path_zipf=args.path_zipf)
+
+    if args.log_only:
+        for line in wl.iterLogLines():
+            sys.stdout.write(line)
+        return 0
+
+    if not args.out_dir:
+        print("An output directory is required unless --log_only is used")
+        sys.exit(1)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    profile_dir, log_path = wl.generate(args.out_dir)
+    print(f"Wrote {str(len(os.listdir(profile_dir)))} profiles to {profile_dir} and {str(args.events)} log lines to {log_path}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,16 +15,18 @@
 #
 
 import argparse
+import contextlib
 
 import shutil
 import os
 import sys
-from MACPolicyParse import GenProfiles
+from MACPolicyParse import GenProfiles, OutputInclude, ProfileCache, SecurityCache, OutputWriter, OutputBundle, DiffReport, RunProfiler
+from MACPolicyParse import GlobalMetrics, MetricsExporter, GlobalLogger
+from MACPolicyParse.Util import DEBUG, ERROR
 
 def create_profile(proc_path, profile_path):
     if proc_path[0] != "/":
-        print("Fully qualified path to the process is required.")
-        sys.exit(0)
+        GlobalLogger.fatal("Fully qualified path to the process is required.")
 
     profile_filename = proc_path.replace("/", ".")[1:]
 
@@ -47,16 +49,62 @@ def main():
     ap.add_argument("--write", help="Writes generated profiles to <dst>")
     ap.add_argument("--create", help="Write a profile for <proc path>")
     ap.add_argument("--diff", help="Compare the original profile and the new one", action="store_true")
+    ap.add_argument("--diff_json", help="Writes the --diff results as JSON to <file> (- for stdout)", required=False)
     ap.add_argument("--skip_profiles", help="Comma separated list of profile filenames in profile_dir to skip", required=False)
+    ap.add_argument("--lazy", help="Only parse and regenerate profiles that have log entries", action="store_true")
+    ap.add_argument("--rewrite_profiles", help="Comma separated list of profile names or filenames to regenerate in --lazy mode", required=False)
+    ap.add_argument("--generalize", help="Collapse file rules into wildcards once a directory has more than <n> entries", type=int, required=False)
+    ap.add_argument("--no_minimize", help="Don't remove redundant rules from the generated profiles", action="store_true")
+    ap.add_argument("--jobs", help="Number of processes used to generate profiles", type=int, default=1)
+    ap.add_argument("--cache", help="File used to reuse unchanged profiles from the previous run", required=False)
+    ap.add_argument("--fsync", help="When to fsync written profiles", choices=OutputWriter.fsync_policies, default="batch")
+    ap.add_argument("--write_threads", help="Number of threads used to write profiles", type=int, default=0)
+    ap.add_argument("--includes", help="Move rules shared by several profiles into include files", action="store_true")
+    ap.add_argument("--include_support", help="Minimum number of profiles sharing rules for an include file", type=int, default=3)
+    ap.add_argument("--include_size", help="Minimum number of rules in an include file", type=int, default=2)
+    ap.add_argument("--check_all", help="Check every profile for security violations and report them all at the end instead of stopping at the first", action="store_true")
+    ap.add_argument("--security_report", help="Writes the --check_all results as JSON to <file>, implies --check_all", required=False)
+    ap.add_argument("--security_cache", help="File used to keep security check results between runs, only new or changed rules are checked", required=False)
+    ap.add_argument("--bundle", help="Writes all generated profiles into a single tar (.tar, .tar.gz, .tar.xz) or concatenated policy file", required=False)
+    ap.add_argument("--profile_run", "--profile-run", help="Prints the time, CPU, items and rate of each stage of the run; with <dir>, also saves cProfile dumps of each stage there", nargs="?", const="", metavar="DIR", required=False)
+    ap.add_argument("--profile_memory", help="Adds the peak memory of each stage to --profile_run (slows the run down)", action="store_true")
+    ap.add_argument("--metrics_textfile", help="Writes run metrics to <file> in the Prometheus textfile format", required=False)
+    ap.add_argument("--metrics_json", help="Writes run metrics to <file> as JSON", required=False)
+    ap.add_argument("--metrics_interval", help="Also export the metrics every <n> seconds during the run", type=float, required=False)
+    ap.add_argument("--quiet", help="Only print errors, besides the profiles and reports asked for", action="store_true")
+    ap.add_argument("--verbose", help="Print every message as it happens, including debug messages, instead of a summary at the end", action="store_true")
 
     args = ap.parse_args()
 
+    if args.quiet and args.verbose:
+        GlobalLogger.error("--quiet can't be used with --verbose")
+        return -1
+
+    if args.quiet:
+        GlobalLogger.configure(level=ERROR)
+    elif args.verbose:
+        GlobalLogger.configure(level=DEBUG, buffered=False)
+
     if args.create:
         create_profile(args.create, args.write)
         return 0
 
     if not args.profile_dir :
-        print("--profile_dir is required.")
+        GlobalLogger.error("--profile_dir is required.")
+        return -1
+
+    if args.diff_json:
+        args.diff = True
+
+    if args.security_report:
+        args.check_all = True
+
+    if args.bundle and (args.write or args.diff):
+        GlobalLogger.error("--bundle can't be used with --write or --diff")
+        return -1
+
+    if args.includes and args.bundle and not OutputBundle.isTarPath(args.bundle):
+        GlobalLogger.error("--includes needs a tar --bundle, include files can't be concatenated into a policy file")
         return -1
 
     if args.skip_profiles:
@@ -69,62 +117,163 @@ def main():
     else:
         skiplist=None
 
-    op = GenProfiles()
+    if args.metrics_interval and not (args.metrics_textfile or args.metrics_json):
+        GlobalLogger.error("--metrics_interval needs --metrics_textfile or --metrics_json")
+        return -1
+
+    exporter = None
+    if args.metrics_textfile or args.metrics_json:
+        exporter = MetricsExporter(GlobalMetrics, args.metrics_textfile, args.metrics_json, args.metrics_interval)
+        exporter.start()
+
+    # With the diff JSON on stdout, everything else printed goes to stderr so stdout
+    # stays parseable
+    json_out = sys.stdout
+    redirect = contextlib.nullcontext()
+    if args.diff_json == "-":
+        redirect = contextlib.redirect_stdout(sys.stderr)
+
+    # The metrics are exported whichever way the run ends
+    with redirect:
+        try:
+            return run(args, skiplist, exporter != None, json_out)
+        finally:
+            if exporter:
+                exporter.stop()
+            GlobalLogger.flush()
+
+#
+# Generates the profiles once the arguments are checked, with metrics set the stages
+# are timed for the stage duration metric even without --profile_run. --diff_json -
+# writes to json_out.
+def run(args, skiplist, metrics, json_out):
+    cache = None
+    if args.cache:
+        cache = ProfileCache(args.cache)
+
+    security_cache = None
+    if args.security_cache:
+        security_cache = SecurityCache(args.security_cache)
+
+    includes = None
+    if args.includes:
+        includes = OutputInclude(args.include_support, args.include_size)
+
+    profiler = None
+    if args.profile_run != None:
+        profiler = RunProfiler(memory=args.profile_memory, cprofile=args.profile_run != "")
+    elif metrics:
+        profiler = RunProfiler()
+
+    op = GenProfiles(lazy=args.lazy, generalize=args.generalize, minimize=not args.no_minimize, cache=cache,
+                     includes=includes, check_all=args.check_all, security_cache=security_cache,
+                     profiler=profiler, diff=args.diff)
+    stage = op.profiler.stage
 
     op.ParseExistingProfiles(args.profile_dir, skiplist)
 
+    if args.rewrite_profiles:
+        op.requestRewrite(args.rewrite_profiles.split(","))
+
     if args.log_file:
         op.ParseLogFile(args.log_file)
 
-    dlist = op.generatePolicyFileList()
+    writer = None
+    if args.write:
+        writer = OutputWriter(args.write, args.fsync, threads=args.write_threads)
+    elif args.bundle:
+        writer = OutputBundle(args.bundle)
 
-    for entry in dlist:
-        if not entry["filename"]:
-            print("Error: Profile list entry found a profile without a name.")
-            print("This usually happens when a log line has a profile")
-            print("name that can't be reconciled to a profile in profile_dir")
-            continue
+    report = None
+    if args.diff:
+        report = DiffReport()
 
-        if not args.write:
-                print("Profile name: " + entry["filename"])
-                print(entry["profile"])
-                continue
-        else:
-            fp = open(args.write + entry["filename"], "w")
-            fp.write(entry["profile"])
-            fp.close()
+    try:
+        with stage("Output"):
+            if writer and not args.diff:
+                op.writePolicyFiles(args.write, args.jobs, writer)
+                dlist = []
+            else:
+                dlist = op.iterPolicyFiles(args.jobs)
 
+            for entry in dlist:
+                if not entry["filename"]:
+                    GlobalLogger.warning("Profile list entry found a profile without a name. This usually happens when "
+                                         "a log line has a profile name that can't be reconciled to a profile in "
+                                         "profile_dir")
+                    continue
 
-    if args.diff:
+                if report:
+                    with stage("Diff") as st:
+                        pd = op.diffPolicyFile(entry)
+                        if pd:
+                            report.add(pd)
+                        st.items += 1
+
+                if not args.write:
+                        print("Profile name: " + entry["filename"])
+                        print(entry["profile"])
+                        continue
+                else:
+                    with stage("Write") as st:
+                        writer.write(entry["filename"], entry["profile"])
+                        st.items += 1
 
-        # Handle loading the new profiles
-        # This is not super clean but we can try to revise later
-        # Write the current profiles to a profile, load/parse under
-        # a new output context, then compare them to the old
-        # output context
-        #
-        # XXX make sure generatePolicyFiles() doesnt change OP state
-        os.mkdir("./_aa_diff_tmp")
-        for entry in dlist:
+            # Profiles skipped by --lazy are copied through unparsed
+            if args.lazy and (args.bundle or (args.write and args.write != args.profile_dir)):
+                for cp in op.getUntouchedProfiles():
+                    with stage("Write") as st:
+                        with open(cp.source, "r") as fp:
+                            writer.write(cp.filename, fp.read())
+                        st.items += 1
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
 
-            fp = open("_aa_diff_tmp/" + entry["filename"], "w")
-            fp.write(entry["profile"])
-            fp.close()
+    if writer:
+        with stage("Finish writes"):
+            written, unchanged = writer.close()
+        if args.bundle:
+            GlobalLogger.info("Wrote %d profiles to %s", len(written), args.bundle)
+        else:
+            GlobalLogger.info("Wrote %d profiles, %d unchanged", len(written), len(unchanged))
+
+    # Messages so far go out before the reports
+    GlobalLogger.flush()
 
-            if args.skip_profile:
-                shutil.copyfile(args.skip_profile, args.write + os.path.basename(args.skip_profile))
+    if report:
+        if args.diff_json == "-":
+            report.writeJSON(json_out)
+        else:
+            report.printText()
+            if args.diff_json:
+                with open(args.diff_json, "w") as fp:
+                    report.writeJSON(fp)
 
-        new_op = GenProfiles()
-        new_op.ParseExistingProfiles("_aa_diff_tmp/")
+    if args.profile_run != None:
+        print("")
+        profiler.printTable()
+        if args.profile_run:
+            profiler.save(args.profile_run)
+            GlobalLogger.info("Saved raw profiles to %s", args.profile_run)
 
-        # Handle loading the old profiles
-        old_op = GenProfiles()
-        old_op.ParseExistingProfiles(args.profile_dir)
+    security_report = op.security_report
+    if security_report:
+        security_report.printSummary()
+        if args.security_report:
+            with open(args.security_report, "w") as fp:
+                security_report.writeJSON(fp)
 
-        new_op.diffProfiles(old_op)
+        if security_report.hasViolations():
+            GlobalLogger.error("Rule generation failed due to security violations.")
+            return 1
 
-        # Cleanup
-        shutil.rmtree("./_aa_diff_tmp")
+    return 0
 
 if __name__ == "__main__":
-    sys.exit(main())
+    try:
+        rc = main()
+    finally:
+        GlobalLogger.flush()
+    sys.exit(rc)